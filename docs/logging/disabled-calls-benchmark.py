@@ -0,0 +1,39 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+Compare the cost of disabled `debug` calls on a standard logger, a confidential
+logger and a bare no-op function call.
+"""
+
+import confidential_ml_utils
+import logging
+import timeit
+
+
+def noop(*args, **kwargs):
+    pass
+
+
+if __name__ == "__main__":
+    number = 1_000_000
+
+    standard = logging.getLogger("standard")
+    standard.setLevel("INFO")
+    standard_time = timeit.timeit(lambda: standard.debug("message"), number=number)
+
+    confidential_ml_utils.enable_confidential_logging()
+    confidential = logging.getLogger("confidential")
+    confidential.setLevel("INFO")
+    confidential_time = timeit.timeit(
+        lambda: confidential.debug("message"), number=number
+    )
+
+    noop_time = timeit.timeit(lambda: noop("message"), number=number)
+
+    for name, elapsed in [
+        ("standard logger", standard_time),
+        ("confidential logger", confidential_time),
+        ("bare function call", noop_time),
+    ]:
+        print(f"{name}: {elapsed / number * 1e9:.0f} ns per disabled call")
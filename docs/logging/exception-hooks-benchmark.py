@@ -0,0 +1,34 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+Compare the cost of calling a function decorated with `prefix_stack_trace` and
+of calling it undecorated, with process-wide exception hooks installed instead.
+"""
+
+from confidential_ml_utils.exceptions import (
+    install_exception_hooks,
+    prefix_stack_trace,
+)
+import timeit
+
+
+def add(x, y):
+    return x + y
+
+
+if __name__ == "__main__":
+    number = 1_000_000
+
+    decorated = prefix_stack_trace()(add)
+    decorated_time = timeit.timeit(lambda: decorated(1, 2), number=number)
+
+    hooks = install_exception_hooks()
+    hooks_time = timeit.timeit(lambda: add(1, 2), number=number)
+    hooks.uninstall()
+
+    for name, elapsed in [
+        ("decorated function", decorated_time),
+        ("exception hooks", hooks_time),
+    ]:
+        print(f"{name}: {elapsed / number * 1e9:.0f} ns per call")
@@ -7,58 +7,748 @@ the exception message itself.
 """
 
 
+import asyncio
+import atexit
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from confidential_ml_utils.constants import DataCategory
 import functools
+import hashlib
+import inspect
 import io
-from traceback import TracebackException
-from typing import Callable
+import json
+import linecache
+import logging
+import threading
+from threading import Lock
+from traceback import (
+    FrameSummary,
+    StackSummary,
+    TracebackException,
+    _cause_message,
+    _context_message,
+)
+from typing import Callable, Union
 import sys
 import re
 import time
+import weakref
 
 
 PREFIX = "SystemLog:"
 SCRUB_MESSAGE = "**Exception message scrubbed**"
+OUTPUT_FORMATS = ("text", "json")
+
+# One lock per output file, so that concurrent traces are not interleaved.
+# Files which cannot be weakly referenced share a single lock.
+_FILE_LOCKS = weakref.WeakKeyDictionary()
+_FILE_LOCKS_LOCK = Lock()
+_SHARED_FILE_LOCK = Lock()
+
+# (file name, function name) of the frames of our decorators, which are not
+# shown in stack traces.
+_HIDDEN_FRAMES = set()
+
+# Longest sequence of frames considered when folding repeated frames.
+_MAX_FOLD_PERIOD = 16
+
+
+class AllowList:
+    """
+    Exception allow list: a list of regex expressions, compiled once and
+    matched case-insensitively. An exception is allowed if any expression
+    matches its type name or message. Decisions are cached per exception type
+    and message, for up to `cache_size` distinct exceptions.
+
+    Build it once and pass it as the `allow_list` argument of
+    `prefix_stack_trace`, `PrefixStackTrace` or
+    `print_prefixed_stack_trace_and_raise`, which also accept plain lists.
+    """
+
+    def __init__(self, patterns: list = [], cache_size: int = 1024):
+        self.patterns = list(patterns)
+        self.cache_size = cache_size
+        self._compile()
+
+    def _compile(self) -> None:
+        # Expressions are compiled separately: joining them into one would
+        # break inline flags, group names and numbered backreferences.
+        self._regexes = tuple(re.compile(p, re.IGNORECASE) for p in self.patterns)
+        self.is_allowed = functools.lru_cache(self.cache_size)(self._match)
+
+    def _match(self, exc_type: type, message: str) -> bool:
+        return any(
+            r.search(message) or r.search(exc_type.__name__) for r in self._regexes
+        )
+
+    def __len__(self) -> int:
+        return len(self.patterns)
+
+    def __iter__(self):
+        return iter(self.patterns)
+
+    def __getstate__(self):
+        # Compiled caches are not picklable, rebuild them on unpickling.
+        return {"patterns": self.patterns, "cache_size": self.cache_size}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._compile()
+
+
+def _as_allow_list(allow_list: Union[list, AllowList]) -> AllowList:
+    if isinstance(allow_list, AllowList):
+        return allow_list
+    return AllowList(allow_list)
+
+
+class ExceptionChainTruncated(Exception):
+    """
+    Placeholder for the exceptions cut from a chain longer than the maximum
+    depth passed to `scrub_exception_traceback`.
+    """
+
+
+def _walk_exception_chain(exception: TracebackException, max_depth: int = None):
+    """
+    Iterate over each distinct exception in the chain of `exception` (its
+    causes and contexts) once, without recursion. Links beyond `max_depth`
+    exceptions are replaced with an `ExceptionChainTruncated` marker.
+    """
+    seen = set()
+    stack = [(exception, 1)]
+    while stack:
+        node, depth = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        yield node
+
+        children = [c for c in (node.__cause__, node.__context__) if c is not None]
+        if max_depth is not None and depth >= max_depth and children:
+            marker = ExceptionChainTruncated(
+                f"Exception chain truncated after {max_depth} exceptions"
+            )
+            node.__cause__ = None
+            node.__context__ = TracebackException(type(marker), marker, None)
+            node.__suppress_context__ = False
+            continue
+        stack.extend((c, depth + 1) for c in reversed(children))
+
+
+def _recursive_traceback_exception() -> bool:
+    """
+    Whether `TracebackException` builds and formats exception chains
+    recursively, which fails on chains longer than the recursion limit. This is
+    the case up to Python 3.9, unless patched (e.g. by `exceptiongroup`).
+    """
+    init = TracebackException.__init__
+    return "is_recursive_call" not in init.__code__.co_varnames
+
+
+def _traceback_exception(exc_info: tuple, max_depth: int = None) -> tuple:
+    """
+    Build the `TracebackException` of `exc_info` without reading source lines
+    or recursing through its chain. Links beyond `max_depth` exceptions are
+    replaced with an `ExceptionChainTruncated` marker. Returns the
+    `TracebackException` and the list of exceptions in its chain.
+    """
+    if not _recursive_traceback_exception():
+        exception = TracebackException(*exc_info, lookup_lines=False)
+        return exception, list(_walk_exception_chain(exception, max_depth))
+
+    # Build one `TracebackException` per exception with its links cut (they
+    # are skipped as already seen), then link them like the recursive
+    # constructor does: causes before contexts, each exception only once.
+    exception, nodes, seen = None, [], set()
+    stack = [(exc_info, None, None, 1)]
+    while stack:
+        (exc_type, exc_value, exc_tb), parent, link, depth = stack.pop()
+        if id(exc_value) in seen:
+            continue
+        seen.add(id(exc_value))
+        links = [
+            (name, getattr(exc_value, name, None))
+            for name in ("__cause__", "__context__")
+        ]
+        node = TracebackException(
+            exc_type,
+            exc_value,
+            exc_tb,
+            lookup_lines=False,
+            _seen={id(chained) for _, chained in links},
+        )
+        nodes.append(node)
+        if parent is None:
+            exception = node
+        else:
+            setattr(parent, link, node)
+
+        links = [(n, c) for n, c in links if c is not None and id(c) not in seen]
+        if max_depth is not None and depth >= max_depth and links:
+            marker = ExceptionChainTruncated(
+                f"Exception chain truncated after {max_depth} exceptions"
+            )
+            node.__context__ = TracebackException(type(marker), marker, None)
+            node.__suppress_context__ = False
+            continue
+        stack.extend(
+            ((type(c), c, c.__traceback__), node, n, depth + 1)
+            for n, c in reversed(links)
+        )
+    return exception, nodes
+
+
+def _exception_chain(exception: TracebackException) -> list:
+    """
+    Exceptions of the chain of `exception` in the order Python prints them
+    (innermost first), each with the link ("cause", "context" or `None`) from
+    the previous one.
+    """
+    chain = []
+    seen = set()
+    node = exception
+    while node is not None and id(node) not in seen:
+        seen.add(id(node))
+        if node.__cause__ is not None:
+            chained, relation = node.__cause__, "cause"
+        elif node.__context__ is not None and not node.__suppress_context__:
+            chained, relation = node.__context__, "context"
+        else:
+            chained, relation = None, None
+        chain.append((node, relation))
+        node = chained
+    chain.reverse()
+    return chain
+
+
+def _format_exception(exception: TracebackException):
+    """
+    Same as `exception.format()`, without recursing through the chain.
+    """
+    if not _recursive_traceback_exception():
+        yield from exception.format()
+        return
+    for node, relation in _exception_chain(exception):
+        if relation == "cause":
+            yield _cause_message
+        elif relation == "context":
+            yield _context_message
+        yield from node.format(chain=False)
+
+
+def _hide_frames_of(function: Callable) -> None:
+    code = function.__code__
+    _HIDDEN_FRAMES.add((code.co_filename, code.co_name))
+
+
+class _BoundedStackSummary(StackSummary):
+    """
+    Stack summary which may contain, besides frames, strings standing for
+    frames which were omitted.
+    """
+
+    # If True, frames are rendered by `_format_frame`, with source lines only
+    # if `lookup_lines` is True.
+    cache_frames = False
+    lookup_lines = True
+
+    def format(self, **kwargs):
+        if self.cache_frames:
+            return [
+                f"  {entry}\n"
+                if isinstance(entry, str)
+                else _format_frame(
+                    entry.filename, entry.lineno, entry.name, self.lookup_lines
+                )
+                for entry in self
+            ]
+        rv = []
+        frames = []
+        for entry in self:
+            if isinstance(entry, str):
+                rv.extend(StackSummary.from_list(frames).format(**kwargs))
+                rv.append(f"  {entry}\n")
+                frames = []
+            else:
+                frames.append(entry)
+        rv.extend(StackSummary.from_list(frames).format(**kwargs))
+        return rv
+
+
+@functools.lru_cache(maxsize=4096)
+def _format_frame(filename: str, lineno: int, name: str, lookup_line: bool) -> str:
+    """
+    Text of a frame of a stack trace, as printed by Python (without the
+    position markers of recent versions). Cached, since the same frames are
+    formatted again and again when a failure repeats.
+    """
+    rv = f'  File "{filename}", line {lineno}, in {name}\n'
+    if lookup_line:
+        line = linecache.getline(filename, lineno).strip()
+        if line:
+            rv += f"    {line}\n"
+    return rv
+
+
+def _fold_repeated_frames(frames: list) -> list:
+    """
+    Replace sequences of frames repeated more than 3 times in a row, as in
+    mutual recursion, with a single occurrence and a line counting repeats.
+    """
+    keys = [(f.filename, f.lineno, f.name) for f in frames]
+    rv = []
+    i = 0
+    while i < len(frames):
+        for period in range(1, _MAX_FOLD_PERIOD + 1):
+            block = slice(i, i + period)
+            j = i + period
+            while keys[j : j + period] == keys[block]:  # noqa: E203
+                j += period
+            repeats = (j - i) // period - 1
+            if repeats >= 3:
+                rv.extend(frames[block])
+                rv.append(f"[Previous {period} frame(s) repeated {repeats} more times]")
+                i = j
+                break
+        else:
+            rv.append(frames[i])
+            i += 1
+    return rv
+
+
+def _bound_stack(
+    stack: StackSummary, max_frames: int, fold_repeated_frames: bool, lookup_lines: bool
+) -> StackSummary:
+    """
+    Remove the frames of our decorators from `stack`, optionally fold repeated
+    frames, keep only the first and last frames (`max_frames` in total) and
+    drop source lines.
+    """
+    frames = [f for f in stack if (f.filename, f.name) not in _HIDDEN_FRAMES]
+    if fold_repeated_frames:
+        frames = _fold_repeated_frames(frames)
+    if max_frames is not None and len(frames) > max_frames:
+        head = (max_frames + 1) // 2
+        tail = max_frames - head
+        omitted = len(frames) - max_frames
+        frames = (
+            frames[:head]
+            + [f"[{omitted} frames omitted]"]
+            + (frames[-tail:] if tail else [])
+        )
+    return _BoundedStackSummary(
+        _copy_frame(f, lookup_lines) if isinstance(f, FrameSummary) else f
+        for f in frames
+    )
+
+
+def _copy_frame(frame: FrameSummary, lookup_line: bool) -> FrameSummary:
+    """
+    Copy of `frame`, which is expected to have been built without looking up
+    its source line. If `lookup_line` is True, the line is read now, else it
+    is never read.
+    """
+    positions = {
+        key: getattr(frame, key)
+        for key in ["end_lineno", "colno", "end_colno"]
+        if hasattr(frame, key)
+    }
+    rv = FrameSummary(
+        frame.filename,
+        frame.lineno,
+        frame.name,
+        lookup_line=False,
+        locals=frame.locals,
+        line=None if lookup_line else "",
+        **positions,
+    )
+    if lookup_line:
+        rv.line  # Reads and stores the line.
+    return rv
 
 
 def scrub_exception_traceback(
     exception: TracebackException,
     scrub_message: str = SCRUB_MESSAGE,
-    allow_list: list = [],
+    allow_list: Union[list, AllowList] = [],
+    max_depth: int = None,
 ) -> TracebackException:
     """
     Scrub exception messages from a `TracebackException` object. The messages
-    will be replaced with `exceptions.SCRUB_MESSAGE`.
+    will be replaced with `exceptions.SCRUB_MESSAGE`. If `max_depth` is
+    provided, exceptions chained beyond that depth are dropped.
     """
-    if not is_exception_allowed(exception, allow_list):
-        exception._str = scrub_message
-    if exception.__cause__:
-        exception.__cause__ = scrub_exception_traceback(
-            exception.__cause__, scrub_message, allow_list
-        )
-    if exception.__context__:
-        exception.__context__ = scrub_exception_traceback(
-            exception.__context__, scrub_message, allow_list
-        )
+    allow_list = _as_allow_list(allow_list)
+    for node in _walk_exception_chain(exception, max_depth):
+        if not is_exception_allowed(node, allow_list):
+            node._str = scrub_message
     return exception
 
 
-def is_exception_allowed(exception: TracebackException, allow_list: list) -> bool:
+def format_scrubbed_exception(
+    exc_info: tuple,
+    scrub_message: str = SCRUB_MESSAGE,
+    keep_message: bool = False,
+    allow_list: Union[list, AllowList] = [],
+    max_chain_depth: int = None,
+    max_frames: int = None,
+    fold_repeated_frames: bool = False,
+    lookup_lines: bool = True,
+) -> str:
+    """
+    Format `exc_info` like `logging.Formatter.formatException` does, with the
+    messages of the exception chain scrubbed unless allowed. See
+    `print_prefixed_stack_trace_and_raise` for the other arguments.
+
+    The text of frames is cached, so formatting the same failure repeatedly
+    neither reads source files nor formats frames again.
+    """
+    exception, nodes = _traceback_exception(exc_info, max_chain_depth)
+    for node in nodes:
+        node.stack = _bound_stack(node.stack, max_frames, fold_repeated_frames, False)
+        node.stack.cache_frames = True
+        node.stack.lookup_lines = lookup_lines
+    _scrub_nodes(nodes, keep_message, scrub_message, _as_allow_list(allow_list))
+    return "".join(_format_exception(exception)).rstrip("\n")
+
+
+def is_exception_allowed(
+    exception: TracebackException, allow_list: Union[list, AllowList]
+) -> bool:
     """
     Check if message is allowed
     Args:
         exception (TracebackException): the exception to test
-        allow_list (list): list of regex expressions. If any expression matches
-            the exception name or message, it will be considered allowed.
+        allow_list (list or AllowList): list of regex expressions. If any
+            expression matches the exception name or message, it will be
+            considered allowed.
     Returns:
         bool: True if message is allowed, False otherwise.
     """
-    # empty list means all messages are allowed
-    for expr in allow_list:
-        if re.search(expr, exception._str, re.IGNORECASE):
-            return True
-        if re.search(expr, exception.exc_type.__name__, re.IGNORECASE):
-            return True
-    return False
+    # empty list means no messages are allowed
+    return _as_allow_list(allow_list).is_allowed(exception.exc_type, exception._str)
+
+
+class TraceDeduplicator:
+    """
+    Bounded cache of exception fingerprints, used to print the stack trace of
+    a given failure only once. A fingerprint is a hash of the exception types
+    and frame locations (file, line, function) of an exception chain: it does
+    not depend on exception messages.
+
+    When passed as the `dedup` argument of `prefix_stack_trace`,
+    `PrefixStackTrace` or `print_prefixed_stack_trace_and_raise`, the first
+    occurrence of a fingerprint is printed in full, followed by a line
+
+        Exception fingerprint <fingerprint> seen 1 times
+
+    and later occurrences only print that line with an updated count. Every
+    `summary_interval` seconds, the counts of all the fingerprints in the
+    cache are also printed. Only the `cache_size` most recently seen
+    fingerprints are remembered.
+
+    Counts are kept per process: a deduplicator pickled to Spark executors
+    counts occurrences separately in each of them.
+    """
+
+    def __init__(self, cache_size: int = 1024, summary_interval: float = 300.0):
+        self.cache_size = cache_size
+        self.summary_interval = summary_interval
+        self._counts = OrderedDict()
+        self._last_summary = time.monotonic()
+        self._lock = Lock()
+
+    @staticmethod
+    def fingerprint(nodes: list) -> str:
+        digest = hashlib.sha1()
+        for node in nodes:
+            digest.update(
+                f"{node.exc_type.__module__}.{node.exc_type.__qualname__}".encode()
+            )
+            for frame in node.stack:
+                if isinstance(frame, FrameSummary):
+                    frame = f"{frame.filename}:{frame.lineno}:{frame.name}"
+                digest.update(f"|{frame}".encode())
+            digest.update(b"\n")
+        return digest.hexdigest()[:16]
+
+    def observe(self, fingerprint: str) -> tuple:
+        """
+        Count an occurrence of `fingerprint`. Returns the number of
+        occurrences, and the list of summary lines to print (empty if no
+        summary is due).
+        """
+        count, summary = self._observe(fingerprint)
+        return count, [
+            f"Exception fingerprint summary: {f} seen {n} times" for f, n in summary
+        ]
+
+    def _observe(self, fingerprint: str) -> tuple:
+        """
+        Same as `observe`, with the summary as `(fingerprint, count)` pairs.
+        """
+        now = time.monotonic()
+        with self._lock:
+            count = self._counts.pop(fingerprint, 0) + 1
+            self._counts[fingerprint] = count
+            if len(self._counts) > self.cache_size:
+                self._counts.popitem(last=False)
+            summary = []
+            if (
+                self.summary_interval
+                and now - self._last_summary >= self.summary_interval
+            ):
+                self._last_summary = now
+                summary = list(self._counts.items())
+        return count, summary
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = Lock()
+
+
+def _file_lock(file: io.TextIOBase) -> Lock:
+    try:
+        with _FILE_LOCKS_LOCK:
+            return _FILE_LOCKS.setdefault(file, Lock())
+    except TypeError:
+        return _SHARED_FILE_LOCK
+
+
+def _emit_prefixed_trace(
+    trace: str, file: io.TextIOBase, logger: logging.Logger
+) -> None:
+    """
+    Write an already prefixed stack trace with a single call, either to
+    `file` or as a single record of `logger`.
+    """
+    if logger is not None:
+        # Lines are already prefixed and scrubbed: do not prefix them again,
+        # but route them as public data.
+        record = logger.makeRecord(
+            logger.name,
+            logging.ERROR,
+            "(unknown file)",
+            0,
+            trace,
+            None,
+            None,
+            extra={"prefix": "", "category": DataCategory.PUBLIC},
+        )
+        logger.handle(record)
+        return
+    with _file_lock(file):
+        file.write(trace + "\n")
+
+
+def _capture_exception(
+    max_chain_depth: int,
+    max_frames: int,
+    fold_repeated_frames: bool,
+    lookup_lines: bool,
+    exc_info: tuple = None,
+) -> tuple:
+    """
+    Capture `exc_info`, by default the exception currently being handled, with
+    bounded stack traces. Returns the `TracebackException` and the list of
+    exceptions in its chain.
+    """
+    # Source lines are only read for the frames kept by `_bound_stack`.
+    exception, nodes = _traceback_exception(exc_info or sys.exc_info(), max_chain_depth)
+    for node in nodes:
+        node.stack = _bound_stack(
+            node.stack, max_frames, fold_repeated_frames, lookup_lines
+        )
+    return exception, nodes
+
+
+def _scrub_nodes(
+    nodes: list, keep_message: bool, scrub_message: str, allow_list: AllowList
+) -> None:
+    if keep_message:
+        return
+    for node in nodes:
+        if not is_exception_allowed(node, allow_list):
+            node._str = scrub_message
+
+
+def _line_prefix(prefix: str, add_timestamp: bool) -> str:
+    if add_timestamp:
+        current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+        return f"{prefix} {current_time} "
+    return f"{prefix} "
+
+
+def _check_output_format(output_format: str) -> None:
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(
+            f"output_format must be one of {OUTPUT_FORMATS}, got {output_format!r}"
+        )
+
+
+def _type_name(exc_type: type) -> str:
+    if exc_type.__module__ in ("__main__", "builtins"):
+        return exc_type.__qualname__
+    return f"{exc_type.__module__}.{exc_type.__qualname__}"
+
+
+def _structure_exception(exception: TracebackException) -> dict:
+    """
+    Picklable and JSON-serializable representation of an already scrubbed
+    exception chain. Exceptions are listed in the order Python prints them
+    (innermost first), and `chained_from` tells whether an exception was
+    raised from ("cause") or while handling ("context") the previous one.
+    """
+    chain = []
+    for node, relation in _exception_chain(exception):
+        frames = []
+        for frame in node.stack:
+            if isinstance(frame, FrameSummary):
+                frames.append(
+                    {
+                        "file": frame.filename,
+                        "line": frame.lineno,
+                        "name": frame.name,
+                        "source": frame.line,
+                    }
+                )
+            else:
+                frames.append({"omitted": frame})
+        chain.append(
+            {
+                "type": _type_name(node.exc_type),
+                "message": node._str,
+                "frames": frames,
+                "chained_from": relation,
+            }
+        )
+    return {"exceptions": chain}
+
+
+def _format_structured_trace(trace: dict) -> list:
+    """
+    Render the output of `_structure_exception` like Python does.
+    """
+    lines = []
+    for entry in trace["exceptions"]:
+        if entry["chained_from"] == "cause":
+            lines += [
+                "",
+                "The above exception was the direct cause of the following "
+                "exception:",
+                "",
+            ]
+        elif entry["chained_from"] == "context":
+            lines += [
+                "",
+                "During handling of the above exception, another exception "
+                "occurred:",
+                "",
+            ]
+        if entry["frames"]:
+            lines.append("Traceback (most recent call last):")
+        for frame in entry["frames"]:
+            if "omitted" in frame:
+                lines.append(f"  {frame['omitted']}")
+                continue
+            lines.append(
+                f'  File "{frame["file"]}", line {frame["line"]}, in {frame["name"]}'
+            )
+            if frame["source"]:
+                lines.append(f"    {frame['source']}")
+        if entry["message"]:
+            lines.append(f"{entry['type']}: {entry['message']}")
+        else:
+            lines.append(entry["type"])
+    return lines
+
+
+def _json_report(prefix: str, trace: dict) -> dict:
+    report = {
+        "prefix": prefix,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime()),
+    }
+    report.update(trace)
+    return report
+
+
+def _json_report_line(prefix: str, report: dict) -> str:
+    """
+    The line is prefixed like text stack traces, so it survives log
+    filtering. The JSON object starts at the first `{`.
+    """
+    return f"{prefix} " + json.dumps(report, separators=(",", ":"), ensure_ascii=False)
+
+
+def _print_prefixed_stack_trace(
+    file: io.TextIOBase,
+    prefix: str,
+    scrub_message: str,
+    keep_message: bool,
+    allow_list: Union[list, AllowList],
+    add_timestamp: bool,
+    max_chain_depth: int,
+    logger: logging.Logger,
+    max_frames: int,
+    fold_repeated_frames: bool,
+    lookup_lines: bool,
+    dedup: TraceDeduplicator,
+    output_format: str,
+    exc_info: tuple = None,
+) -> bool:
+    """
+    Print `exc_info`, by default the exception currently being handled, as
+    described in `print_prefixed_stack_trace_and_raise`. Returns whether the
+    message of the outermost exception is allowed.
+    """
+    _check_output_format(output_format)
+    allow_list = _as_allow_list(allow_list)
+
+    # scrub the log
+    exception, nodes = _capture_exception(
+        max_chain_depth, max_frames, fold_repeated_frames, lookup_lines, exc_info
+    )
+    allowed = keep_message or is_exception_allowed(exception, allow_list)
+
+    count, summary = 1, []
+    if dedup is not None:
+        fingerprint = dedup.fingerprint(nodes)
+        count, summary = dedup._observe(fingerprint)
+    if count == 1:
+        _scrub_nodes(nodes, keep_message, scrub_message, allow_list)
+
+    if output_format == "json":
+        report = _json_report(
+            prefix, _structure_exception(exception) if count == 1 else {}
+        )
+        if dedup is not None:
+            report.update(fingerprint=fingerprint, count=count)
+            if summary:
+                report["summary"] = dict(summary)
+        lines = [_json_report_line(prefix, report)]
+    else:
+        line_prefix = _line_prefix(prefix, add_timestamp)
+        lines = []
+        if count == 1:
+            for execution in _format_exception(exception):
+                for line in execution.splitlines():
+                    lines.append(line_prefix + line)
+        if dedup is not None:
+            lines.append(
+                f"{line_prefix}Exception fingerprint {fingerprint} seen {count} times"
+            )
+            lines.extend(
+                f"{line_prefix}Exception fingerprint summary: {f} seen {n} times"
+                for f, n in summary
+            )
+    _emit_prefixed_trace("\n".join(lines), file, logger)
+    return allowed
 
 
 def print_prefixed_stack_trace_and_raise(
@@ -66,45 +756,68 @@ def print_prefixed_stack_trace_and_raise(
     prefix: str = PREFIX,
     scrub_message: str = SCRUB_MESSAGE,
     keep_message: bool = False,
-    allow_list: list = [],
+    allow_list: Union[list, AllowList] = [],
     add_timestamp: bool = False,
     err: BaseException = None,
+    max_chain_depth: int = None,
+    logger: logging.Logger = None,
+    max_frames: int = None,
+    fold_repeated_frames: bool = False,
+    lookup_lines: bool = True,
+    dedup: TraceDeduplicator = None,
+    output_format: str = "text",
 ) -> None:
     """
     Print the current exception and stack trace to `file` (usually client
-    standard error), prefixing the stack trace with `prefix`.
+    standard error), prefixing the stack trace with `prefix`. The whole trace
+    is written at once, so traces printed concurrently are not interleaved.
     Args:
         keep_message (bool): if True, don't scrub message. If false, scrub (unless
             allowed).
-        allow_list (list): exception allow_list. Ignored if keep_message is True. If
-            empty all messages will be srubbed.
+        allow_list (list or AllowList): exception allow_list. Ignored if
+            keep_message is True. If empty all messages will be srubbed.
         err: the error that was thrown. None accepted for backwards compatibility.
+        max_chain_depth (int): if provided, only print that many exceptions
+            of the chain of causes and contexts.
+        logger (logging.Logger): if provided, log the prefixed stack trace as
+            a single `PUBLIC` record of this logger instead of printing it to
+            `file`.
+        max_frames (int): if provided, only print the first and last frames
+            of each stack trace, that many in total.
+        fold_repeated_frames (bool): if True, print sequences of frames
+            repeated many times in a row (e.g. in recursion) only once.
+        lookup_lines (bool): if False, do not read and print source lines.
+        dedup (TraceDeduplicator): if provided, only print the stack trace of
+            the first occurrence of each failure, and a single line for the
+            others.
+        output_format (str): "text" to print the stack trace like Python
+            does, or "json" to print a single line made of `prefix` followed
+            by a JSON object with `prefix`, `timestamp` and `exceptions` keys
+            (and `fingerprint`, `count` and `summary` keys if `dedup` is
+            provided). Each exception has `type`, `message`, `frames` and
+            `chained_from` keys, and they are listed in the order Python
+            prints them.
     """
-    # scrub the log
-    exception = TracebackException(*sys.exc_info())
-    if keep_message:
-        scrubbed_exception = exception
-    else:
-        scrubbed_exception = scrub_exception_traceback(
-            exception, scrub_message, allow_list
-        )
-    traceback = list(scrubbed_exception.format())
-    for execution in traceback:
-        if "return function(*func_args, **func_kwargs)" in execution:
-            # Do not show the stack trace for our decorator.
-            continue
-        lines = execution.splitlines()
-        for line in lines:
-            if add_timestamp:
-                current_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-                print(f"{prefix} {current_time} {line}", file=file)
-            else:
-                print(f"{prefix} {line}", file=file)
+    allowed = _print_prefixed_stack_trace(
+        file,
+        prefix,
+        scrub_message,
+        keep_message,
+        allow_list,
+        add_timestamp,
+        max_chain_depth,
+        logger,
+        max_frames,
+        fold_repeated_frames,
+        lookup_lines,
+        dedup,
+        output_format,
+    )
 
     # raise compliant error
     if not err:
         raise
-    elif keep_message or is_exception_allowed(exception, allow_list):
+    elif allowed:
         if not err.args:
             raise type(err) from err
         else:
@@ -132,38 +845,121 @@ class _PrefixStackTraceWrapper:
         prefix: str,
         scrub_message: str,
         keep_message: bool,
-        allow_list: list,
+        allow_list: Union[list, AllowList],
         add_timestamp: bool,
+        logger: logging.Logger = None,
+        max_chain_depth: int = None,
+        max_frames: int = None,
+        fold_repeated_frames: bool = False,
+        lookup_lines: bool = True,
+        dedup: TraceDeduplicator = None,
+        output_format: str = "text",
     ) -> None:
-        self.allow_list = allow_list
+        _check_output_format(output_format)
+        self.allow_list = _as_allow_list(allow_list)
         self.disable = disable
         self.file = file
         self.keep_message = keep_message
         self.prefix = prefix
         self.scrub_message = scrub_message
         self.add_timestamp = add_timestamp
+        self.logger = logger
+        self.max_chain_depth = max_chain_depth
+        self.max_frames = max_frames
+        self.fold_repeated_frames = fold_repeated_frames
+        self.lookup_lines = lookup_lines
+        self.dedup = dedup
+        self.output_format = output_format
+
+    def _print_and_raise(self, err: BaseException) -> None:
+        """
+        Must be called while handling `err`.
+        """
+        print_prefixed_stack_trace_and_raise(
+            file=self.file,
+            prefix=self.prefix,
+            scrub_message=self.scrub_message,
+            keep_message=self.keep_message,
+            allow_list=self.allow_list,
+            add_timestamp=self.add_timestamp,
+            err=err,
+            logger=self.logger,
+            max_chain_depth=self.max_chain_depth,
+            max_frames=self.max_frames,
+            fold_repeated_frames=self.fold_repeated_frames,
+            lookup_lines=self.lookup_lines,
+            dedup=self.dedup,
+            output_format=self.output_format,
+        )
 
     def __call__(self, function) -> Callable:
-        @functools.wraps(function)
-        def wrapper(*func_args, **func_kwargs):
-            """
-            Create a wrapper which catches exceptions thrown by `function`,
-            scrub exception messages, and logs the prefixed stack trace.
-            """
-            try:
-                return function(*func_args, **func_kwargs)
-            except BaseException as err:
-                print_prefixed_stack_trace_and_raise(
-                    self.file,
-                    self.prefix,
-                    self.scrub_message,
-                    self.keep_message,
-                    self.allow_list,
-                    self.add_timestamp,
-                    err,
-                )
+        if self.disable:
+            return function
 
-        return function if self.disable else wrapper
+        # Closing a generator or cancelling a task is not a failure.
+        control_flow = (GeneratorExit, asyncio.CancelledError)
+
+        if inspect.iscoroutinefunction(function):
+
+            @functools.wraps(function)
+            async def wrapper(*func_args, **func_kwargs):
+                try:
+                    return await function(*func_args, **func_kwargs)
+                except control_flow:
+                    raise
+                except BaseException as err:
+                    self._print_and_raise(err)
+
+        elif inspect.isasyncgenfunction(function):
+
+            @functools.wraps(function)
+            async def wrapper(*func_args, **func_kwargs):
+                generator = function(*func_args, **func_kwargs)
+                try:
+                    value = await generator.__anext__()
+                    while True:
+                        try:
+                            sent = yield value
+                        except GeneratorExit:
+                            await generator.aclose()
+                            raise
+                        except BaseException as thrown:
+                            value = await generator.athrow(thrown)
+                        else:
+                            value = await generator.asend(sent)
+                except StopAsyncIteration:
+                    return
+                except control_flow:
+                    raise
+                except BaseException as err:
+                    self._print_and_raise(err)
+
+        elif inspect.isgeneratorfunction(function):
+
+            @functools.wraps(function)
+            def wrapper(*func_args, **func_kwargs):
+                try:
+                    return (yield from function(*func_args, **func_kwargs))
+                except control_flow:
+                    raise
+                except BaseException as err:
+                    self._print_and_raise(err)
+
+        else:
+
+            @functools.wraps(function)
+            def wrapper(*func_args, **func_kwargs):
+                """
+                Create a wrapper which catches exceptions thrown by `function`,
+                scrub exception messages, and logs the prefixed stack trace.
+                """
+                try:
+                    return function(*func_args, **func_kwargs)
+                except BaseException as err:
+                    self._print_and_raise(err)
+
+        _hide_frames_of(wrapper)
+        return wrapper
 
 
 def prefix_stack_trace(
@@ -172,8 +968,15 @@ def prefix_stack_trace(
     prefix: str = PREFIX,
     scrub_message: str = SCRUB_MESSAGE,
     keep_message: bool = False,
-    allow_list: list = [],
+    allow_list: Union[list, AllowList] = [],
     add_timestamp: bool = False,
+    logger: logging.Logger = None,
+    max_chain_depth: int = None,
+    max_frames: int = None,
+    fold_repeated_frames: bool = False,
+    lookup_lines: bool = True,
+    dedup: TraceDeduplicator = None,
+    output_format: str = "text",
 ) -> Callable:
     """
     Decorator which wraps the decorated function and prints the stack trace of
@@ -184,14 +987,41 @@ def prefix_stack_trace(
         @prefix_stack_trace()
         def foo(x):
             pass
+
+    Coroutine functions, generators and asynchronous generators are supported:
+    exceptions raised while awaiting or iterating them are handled too.
+
+    If `logger` is provided, stack traces are logged through it instead of
+    printed to `file`. See `print_prefixed_stack_trace_and_raise` for the
+    options bounding the size of stack traces and `output_format`, and
+    `TraceDeduplicator` for `dedup`.
     """
 
     return _PrefixStackTraceWrapper(
-        file, disable, prefix, scrub_message, keep_message, allow_list, add_timestamp
+        file,
+        disable,
+        prefix,
+        scrub_message,
+        keep_message,
+        allow_list,
+        add_timestamp,
+        logger,
+        max_chain_depth,
+        max_frames,
+        fold_repeated_frames,
+        lookup_lines,
+        dedup,
+        output_format,
     )
 
 
 class PrefixStackTrace:
+    """
+    Context manager printing the prefixed stack trace of exceptions raised
+    within it, with the same options as `prefix_stack_trace`. It may be used
+    both with `with` and `async with` statements.
+    """
+
     def __init__(
         self,
         file: io.TextIOBase = sys.stderr,
@@ -200,19 +1030,42 @@ class PrefixStackTrace:
         scrub_message: str = SCRUB_MESSAGE,
         keep_message: bool = False,
         add_timestamp: bool = False,
-        allow_list: list = [],
+        allow_list: Union[list, AllowList] = [],
+        logger: logging.Logger = None,
+        max_chain_depth: int = None,
+        max_frames: int = None,
+        fold_repeated_frames: bool = False,
+        lookup_lines: bool = True,
+        dedup: TraceDeduplicator = None,
+        output_format: str = "text",
     ):
+        _check_output_format(output_format)
         self.file = file
         self.disable = disable
         self.prefix = prefix
         self.scrub_message = scrub_message
         self.keep_message = keep_message
         self.add_timestamp = add_timestamp
-        self.allow_list = allow_list
+        self.allow_list = _as_allow_list(allow_list)
+        self.logger = logger
+        self.max_chain_depth = max_chain_depth
+        self.max_frames = max_frames
+        self.fold_repeated_frames = fold_repeated_frames
+        self.lookup_lines = lookup_lines
+        self.dedup = dedup
+        self.output_format = output_format
 
     def __enter__(self):
         pass
 
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is asyncio.CancelledError:
+            return
+        self.__exit__(exc_type, exc_value, traceback)
+
     def __exit__(self, exc_type, exc_value, traceback):
         if exc_type and not self.disable:
             print_prefixed_stack_trace_and_raise(
@@ -223,4 +1076,285 @@ class PrefixStackTrace:
                 allow_list=self.allow_list,
                 add_timestamp=self.add_timestamp,
                 err=exc_value,
+                logger=self.logger,
+                max_chain_depth=self.max_chain_depth,
+                max_frames=self.max_frames,
+                fold_repeated_frames=self.fold_repeated_frames,
+                lookup_lines=self.lookup_lines,
+                dedup=self.dedup,
+                output_format=self.output_format,
+            )
+
+
+class ScrubbedWorkerError(Exception):
+    """
+    Raised in the parent process in place of an exception raised by a worker
+    function wrapped with `scrub_worker_exceptions`. Only the scrubbed
+    message and the structured stack trace (`trace`) cross the process
+    boundary, never the original exception object or its arguments.
+    """
+
+    def __init__(self, message: str, trace: dict):
+        super(ScrubbedWorkerError, self).__init__(message, trace)
+        self.trace = trace
+
+    def __str__(self):
+        return self.args[0]
+
+
+class _ScrubbingCall:
+    """
+    Picklable wrapper running `function` in a worker process and converting
+    its exceptions into `ScrubbedWorkerError`. Only the scrubbing options of
+    the stack trace wrapper are shipped, since files and loggers usually
+    cannot be pickled.
+    """
+
+    def __init__(self, function: Callable, stack_trace: "_PrefixStackTraceWrapper"):
+        self.function = function
+        self.prefix = stack_trace.prefix
+        self.scrub_message = stack_trace.scrub_message
+        self.keep_message = stack_trace.keep_message
+        self.allow_list = stack_trace.allow_list
+        self.max_chain_depth = stack_trace.max_chain_depth
+        self.max_frames = stack_trace.max_frames
+        self.fold_repeated_frames = stack_trace.fold_repeated_frames
+        self.lookup_lines = stack_trace.lookup_lines
+
+    def __call__(self, *args, **kwargs):
+        try:
+            return self.function(*args, **kwargs)
+        except Exception:
+            exception, nodes = _capture_exception(
+                self.max_chain_depth,
+                self.max_frames,
+                self.fold_repeated_frames,
+                self.lookup_lines,
             )
+            _scrub_nodes(nodes, self.keep_message, self.scrub_message, self.allow_list)
+            trace = _structure_exception(exception)
+            last = trace["exceptions"][-1]
+            message = f"{self.prefix} {last['type']}: {last['message']}"
+        # Raised outside the except clause, so the original exception is not
+        # chained to (and pickled with) the scrubbed one.
+        raise ScrubbedWorkerError(message, trace)
+
+
+_hide_frames_of(_ScrubbingCall.__call__)
+
+
+def scrub_worker_exceptions(
+    function: Callable, stack_trace: "_PrefixStackTraceWrapper" = None
+) -> Callable:
+    """
+    Wrap `function` so that, when run in a worker process (e.g. with
+    `multiprocessing.Pool.map`), exceptions it raises are scrubbed according
+    to `stack_trace` (by default `prefix_stack_trace()`) and re-raised as a
+    compact `ScrubbedWorkerError`. Use `print_worker_trace` in the parent to
+    print them, e.g.
+
+        with multiprocessing.Pool() as pool:
+            try:
+                pool.map(scrub_worker_exceptions(foo), items)
+            except ScrubbedWorkerError as e:
+                print_worker_trace(e)
+                raise
+    """
+    return _ScrubbingCall(function, stack_trace or prefix_stack_trace())
+
+
+def print_worker_trace(
+    err: ScrubbedWorkerError, stack_trace: "_PrefixStackTraceWrapper" = None
+) -> None:
+    """
+    Print the stack trace carried by `err` with the prefix, timestamp, output
+    format and destination (file or logger) of `stack_trace`.
+    """
+    stack_trace = stack_trace or prefix_stack_trace()
+    if stack_trace.output_format == "json":
+        report = _json_report(stack_trace.prefix, err.trace)
+        lines = [_json_report_line(stack_trace.prefix, report)]
+    else:
+        line_prefix = _line_prefix(stack_trace.prefix, stack_trace.add_timestamp)
+        lines = [line_prefix + line for line in _format_structured_trace(err.trace)]
+    _emit_prefixed_trace("\n".join(lines), stack_trace.file, stack_trace.logger)
+
+
+class ScrubbingProcessPoolExecutor(ProcessPoolExecutor):
+    """
+    `ProcessPoolExecutor` running submitted functions with
+    `scrub_worker_exceptions`. The prefixed stack trace of a failed call is
+    printed in the parent as soon as it completes, and its future raises the
+    `ScrubbedWorkerError`.
+    """
+
+    def __init__(self, *args, stack_trace: "_PrefixStackTraceWrapper" = None, **kwargs):
+        super(ScrubbingProcessPoolExecutor, self).__init__(*args, **kwargs)
+        self.stack_trace = stack_trace or prefix_stack_trace()
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        if self.stack_trace.disable:
+            return super(ScrubbingProcessPoolExecutor, self).submit(fn, *args, **kwargs)
+        future = super(ScrubbingProcessPoolExecutor, self).submit(
+            _ScrubbingCall(fn, self.stack_trace), *args, **kwargs
+        )
+        future.add_done_callback(self._print_worker_trace)
+        return future
+
+    def _print_worker_trace(self, future: Future) -> None:
+        if future.cancelled():
+            return
+        err = future.exception()
+        if isinstance(err, ScrubbedWorkerError):
+            print_worker_trace(err, self.stack_trace)
+
+
+class ExceptionHooks:
+    """
+    Process-wide hooks printing the prefixed stack trace of uncaught
+    exceptions with the options of `stack_trace` (by default
+    `prefix_stack_trace()`), as an alternative to decorating functions, which
+    adds a frame and a `try` block to each of their calls. They cover
+    `sys.excepthook`, `threading.excepthook` and, for the event loops passed
+    to `install_loop`, asyncio exception handlers. Output is flushed at exit.
+
+    Unlike the decorator, hooks only see exceptions which are not caught: if
+    an exception is handled somewhere up the stack, nothing is printed.
+    """
+
+    def __init__(self, stack_trace: _PrefixStackTraceWrapper = None):
+        self.stack_trace = stack_trace or prefix_stack_trace()
+        self._installed = False
+        self._previous_excepthook = None
+        self._previous_threading_excepthook = None
+        self._loops = []
+
+    def install(self, loop: asyncio.AbstractEventLoop = None) -> "ExceptionHooks":
+        if self.stack_trace.disable:
+            return self
+        if not self._installed:
+            self._previous_excepthook = sys.excepthook
+            sys.excepthook = self.excepthook
+            if hasattr(threading, "excepthook"):
+                self._previous_threading_excepthook = threading.excepthook
+                threading.excepthook = self.threading_excepthook
+            atexit.register(self.flush)
+            self._installed = True
+        if loop is not None:
+            self.install_loop(loop)
+        return self
+
+    def install_loop(self, loop: asyncio.AbstractEventLoop) -> None:
+        """
+        Handle the exceptions reported to `loop`, e.g. those of tasks which
+        are never awaited. With `asyncio.run`, call this at the start of the
+        main coroutine with `asyncio.get_running_loop()`.
+        """
+        self._loops.append((loop, loop.get_exception_handler()))
+        loop.set_exception_handler(self.asyncio_exception_handler)
+
+    def uninstall(self) -> None:
+        """
+        Restore the hooks and handlers replaced by `install`, and flush.
+        """
+        if not self._installed:
+            return
+        if sys.excepthook == self.excepthook:
+            sys.excepthook = self._previous_excepthook
+        if self._previous_threading_excepthook is not None:
+            if threading.excepthook == self.threading_excepthook:
+                threading.excepthook = self._previous_threading_excepthook
+        for loop, handler in reversed(self._loops):
+            if not loop.is_closed():
+                loop.set_exception_handler(handler)
+        self._loops = []
+        atexit.unregister(self.flush)
+        self._installed = False
+        self.flush()
+
+    def excepthook(self, exc_type, exc_value, exc_traceback) -> None:
+        if issubclass(exc_type, KeyboardInterrupt):
+            self._previous_excepthook(exc_type, exc_value, exc_traceback)
+            return
+        self._print((exc_type, exc_value, exc_traceback))
+
+    def threading_excepthook(self, args) -> None:
+        if args.exc_type is SystemExit:
+            # Silently ignored by the default hook too.
+            return
+        self._print((args.exc_type, args.exc_value, args.exc_traceback))
+
+    def asyncio_exception_handler(
+        self, loop: asyncio.AbstractEventLoop, context: dict
+    ) -> None:
+        # Only the message is printed: other items of the context, such as
+        # the failed task, may include the exception message in their repr.
+        if self.stack_trace.output_format == "text":
+            _emit_prefixed_trace(
+                f"{self.stack_trace.prefix} {context.get('message')}",
+                self.stack_trace.file,
+                self.stack_trace.logger,
+            )
+        exception = context.get("exception")
+        if exception is not None:
+            self._print((type(exception), exception, exception.__traceback__))
+
+    def flush(self) -> None:
+        """
+        Flush the file or the handlers of the logger stack traces are printed
+        to. Safe to call during interpreter shutdown.
+        """
+        try:
+            if self.stack_trace.logger is None:
+                self.stack_trace.file.flush()
+                return
+            logger = self.stack_trace.logger
+            while logger:
+                for handler in logger.handlers:
+                    handler.flush()
+                logger = logger.parent if logger.propagate else None
+        except (OSError, ValueError):
+            # Already closed.
+            pass
+
+    def _print(self, exc_info: tuple) -> None:
+        stack_trace = self.stack_trace
+        try:
+            _print_prefixed_stack_trace(
+                stack_trace.file,
+                stack_trace.prefix,
+                stack_trace.scrub_message,
+                stack_trace.keep_message,
+                stack_trace.allow_list,
+                stack_trace.add_timestamp,
+                stack_trace.max_chain_depth,
+                stack_trace.logger,
+                stack_trace.max_frames,
+                stack_trace.fold_repeated_frames,
+                stack_trace.lookup_lines,
+                stack_trace.dedup,
+                stack_trace.output_format,
+                exc_info,
+            )
+        except Exception:
+            # If the hook itself fails, Python prints the original, unscrubbed
+            # exception: print a minimal line instead.
+            sys.__stderr__.write(
+                f"{stack_trace.prefix} {_type_name(exc_info[0])}: "
+                f"{stack_trace.scrub_message}\n"
+            )
+
+
+def install_exception_hooks(
+    stack_trace: _PrefixStackTraceWrapper = None,
+    loop: asyncio.AbstractEventLoop = None,
+) -> ExceptionHooks:
+    """
+    Install `ExceptionHooks` printing uncaught exceptions with the options of
+    `stack_trace`, e.g.
+
+        hooks = install_exception_hooks(prefix_stack_trace(allow_list=[...]))
+
+    and call `hooks.uninstall()` to restore the previous hooks.
+    """
+    return ExceptionHooks(stack_trace).install(loop)
@@ -0,0 +1,471 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+Logging handlers tuned for writing large volumes of confidential logs.
+"""
+
+
+from collections import deque, OrderedDict
+from confidential_ml_utils.constants import DataCategory
+from confidential_ml_utils.logging import CategoryRoutingHandler
+import gzip
+import logging
+from logging import ERROR
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+
+
+class BufferedRotatingFileHandler(logging.Handler):
+    """
+    File handler which batches formatted records in memory and writes them
+    with a single call once `buffer_size` bytes are buffered, a record of
+    level `flush_level` or above is handled, or `flush_interval` seconds have
+    passed since the last write.
+
+    Once the file would grow past `max_bytes` (if positive), it is renamed to
+    `<filename>.<n>` (with `n` increasing) and, if `compress` is True, that
+    segment is gzipped by a background thread into `<filename>.<n>.gz`. If
+    `backup_count` is positive, only that many segments are kept.
+
+    Use it like any other handler, e.g.
+
+        enable_confidential_logging(
+            handlers=[BufferedRotatingFileHandler("train.log")]
+        )
+    """
+
+    terminator = "\n"
+
+    def __init__(
+        self,
+        filename: str,
+        max_bytes: int = 100 * 1024 * 1024,
+        backup_count: int = 0,
+        buffer_size: int = 1024 * 1024,
+        flush_interval: float = 1.0,
+        flush_level: int = ERROR,
+        compress: bool = True,
+        encoding: str = "utf-8",
+    ):
+        super(BufferedRotatingFileHandler, self).__init__()
+        self.filename = os.path.abspath(filename)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.flush_level = flush_level
+        self.compress = compress
+        self.encoding = encoding
+
+        self._buffer = []
+        self._buffered = 0
+        self._last_flush = time.monotonic()
+        self._stream = None
+        self._segment_pattern = re.compile(
+            re.escape(os.path.basename(self.filename)) + r"\.(\d+)(\.gz)?$"
+        )
+        segments = self.segments()
+        self._segment = segments[-1][0] if segments else 0
+
+        self._compress_queue = None
+        self._compressor = None
+        self._stop_flusher = threading.Event()
+        self._flusher = None
+        if flush_interval:
+            self._flusher = threading.Thread(
+                target=self._flush_periodically, daemon=True
+            )
+            self._flusher.start()
+
+    def emit(self, record):
+        try:
+            data = (self.format(record) + self.terminator).encode(
+                self.encoding, "backslashreplace"
+            )
+            self._buffer.append(data)
+            self._buffered += len(data)
+            if (
+                self._buffered >= self.buffer_size
+                or record.levelno >= self.flush_level
+                or (
+                    self.flush_interval
+                    and time.monotonic() - self._last_flush >= self.flush_interval
+                )
+            ):
+                self._write_buffer()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        with self.lock:
+            self._write_buffer()
+
+    def close(self):
+        with self.lock:
+            self._write_buffer()
+            if self._stream:
+                self._stream.close()
+                self._stream = None
+        self._stop_flusher.set()
+        if self._flusher and self._flusher is not threading.current_thread():
+            self._flusher.join()
+        if self._compressor:
+            self._compress_queue.put(None)
+            self._compressor.join()
+            self._compressor = None
+        super(BufferedRotatingFileHandler, self).close()
+
+    def segments(self) -> list:
+        """
+        Sorted list of `(n, path)` tuples for the rotated segments of this
+        handler's file.
+        """
+        directory = os.path.dirname(self.filename)
+        rv = {}
+        for name in os.listdir(directory):
+            m = self._segment_pattern.match(name)
+            if m:
+                rv[int(m.group(1))] = os.path.join(directory, name)
+        return sorted(rv.items())
+
+    def _write_buffer(self):
+        """
+        Write the buffered records with a single call. The caller must hold
+        the handler lock.
+        """
+        self._last_flush = time.monotonic()
+        if not self._buffer:
+            return
+        data = b"".join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        if self._stream is None:
+            self._stream = open(self.filename, "ab", buffering=0)
+        size = self._stream.tell()
+        if self.max_bytes > 0 and size and size + len(data) > self.max_bytes:
+            self._rotate()
+        self._stream.write(data)
+
+    def _rotate(self):
+        self._stream.close()
+        self._segment += 1
+        segment = f"{self.filename}.{self._segment}"
+        os.rename(self.filename, segment)
+        self._stream = open(self.filename, "ab", buffering=0)
+        if self.compress:
+            if self._compressor is None:
+                self._compress_queue = queue.Queue()
+                self._compressor = threading.Thread(
+                    target=self._compress_segments, daemon=True
+                )
+                self._compressor.start()
+            self._compress_queue.put(segment)
+        else:
+            self._prune()
+
+    def _prune(self):
+        if self.backup_count > 0:
+            for _, path in self.segments()[: -self.backup_count]:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _compress_segments(self):
+        while True:
+            segment = self._compress_queue.get()
+            if segment is None:
+                return
+            try:
+                with open(segment, "rb") as src:
+                    with gzip.open(segment + ".gz", "wb") as dst:
+                        shutil.copyfileobj(src, dst)
+                os.remove(segment)
+            except OSError:
+                # Keep the uncompressed segment, it is still a valid log.
+                pass
+            self._prune()
+
+    def _flush_periodically(self):
+        while not self._stop_flusher.wait(self.flush_interval):
+            self.flush()
+
+
+def buffered_category_handler(
+    public_filename: str, private_filename: str = None, **kwargs
+) -> CategoryRoutingHandler:
+    """
+    Create a handler writing `PUBLIC` records to `public_filename` and
+    `PRIVATE` records to `private_filename` (or nowhere, if it is not
+    provided), each through a `BufferedRotatingFileHandler` configured with
+    `kwargs`.
+    """
+    routes = {
+        DataCategory.PUBLIC: BufferedRotatingFileHandler(public_filename, **kwargs)
+    }
+    if private_filename:
+        routes[DataCategory.PRIVATE] = BufferedRotatingFileHandler(
+            private_filename, **kwargs
+        )
+    return CategoryRoutingHandler(routes)
+
+
+class RankForwardingHandler(logging.Handler):
+    """
+    Handler which ships records, in batches, from one rank of a distributed
+    job to a `RankLogCollector` listening on `address`. Records are tagged
+    with `rank` (by default the `RANK` environment variable) and the process
+    id. Batches are sent once `batch_size` records are pending, a record of
+    level `flush_level` or above is handled, or every `flush_interval`
+    seconds.
+
+    If `rank_zero_public` is True, `PUBLIC` records are only shipped from rank
+    0, since they are usually identical across ranks.
+
+    While the collector cannot be reached, at most `max_pending` records are
+    kept (the oldest ones are dropped and counted in `dropped`), and
+    connecting is retried after `retry_interval` seconds, doubling after each
+    failure up to one minute.
+    """
+
+    def __init__(
+        self,
+        address,
+        rank: int = None,
+        authkey: bytes = None,
+        batch_size: int = 256,
+        flush_interval: float = 1.0,
+        flush_level: int = ERROR,
+        rank_zero_public: bool = True,
+        max_pending: int = 10000,
+        retry_interval: float = 1.0,
+    ):
+        super(RankForwardingHandler, self).__init__()
+        self.address = address
+        self.rank = int(os.environ.get("RANK", 0)) if rank is None else rank
+        self.authkey = authkey
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.flush_level = flush_level
+        self.rank_zero_public = rank_zero_public
+        self.retry_interval = retry_interval
+        self.dropped = 0
+        self._batch = deque(maxlen=max_pending)
+        self._connection = None
+        self._retry_at = 0.0
+        self._retry_delay = retry_interval
+
+        self._stop_flusher = threading.Event()
+        self._flusher = None
+        if flush_interval:
+            self._flusher = threading.Thread(
+                target=self._flush_periodically, daemon=True
+            )
+            self._flusher.start()
+
+    def emit(self, record):
+        category = getattr(record, "category", DataCategory.PRIVATE)
+        if self.rank_zero_public and self.rank and category == DataCategory.PUBLIC:
+            return
+        try:
+            exc_text = record.exc_text
+            if record.exc_info and not exc_text:
+                exc_text = logging.Formatter().formatException(record.exc_info)
+            if len(self._batch) == self._batch.maxlen:
+                self.dropped += 1
+            self._batch.append(
+                {
+                    "name": record.name,
+                    "levelno": record.levelno,
+                    "levelname": record.levelname,
+                    "msg": record.getMessage(),
+                    "created": record.created,
+                    "exc_text": exc_text,
+                    "prefix": getattr(record, "prefix", ""),
+                    "category": category,
+                    "rank": self.rank,
+                    "process": record.process,
+                }
+            )
+            if (
+                len(self._batch) >= self.batch_size
+                or record.levelno >= self.flush_level
+            ):
+                self._send_batch()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        with self.lock:
+            self._send_batch()
+
+    def close(self):
+        self._stop_flusher.set()
+        if self._flusher and self._flusher is not threading.current_thread():
+            self._flusher.join()
+        with self.lock:
+            self._retry_at = 0.0
+            self._send_batch()
+            if self._connection:
+                self._connection.close()
+                self._connection = None
+        super(RankForwardingHandler, self).close()
+
+    def _send_batch(self):
+        if not self._batch or time.monotonic() < self._retry_at:
+            return
+        batch = list(self._batch)
+        try:
+            if self._connection is None:
+                self._connection = Client(self.address, authkey=self.authkey)
+            self._connection.send(batch)
+        except Exception:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+            self._retry_at = time.monotonic() + self._retry_delay
+            self._retry_delay = min(2 * self._retry_delay, 60.0)
+            raise
+        self._batch.clear()
+        self._retry_delay = self.retry_interval
+
+    def _flush_periodically(self):
+        while not self._stop_flusher.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                # Retried by the next flush; failures of records being
+                # emitted are reported by `handleError`.
+                pass
+
+
+class RankLogCollector:
+    """
+    Collects records shipped by the `RankForwardingHandler` of every rank on a
+    node, and emits them through `handlers` from a single process, so ranks
+    do not contend on the same files. Identical lines (same logger, level,
+    category and message) received from several ranks within
+    `dedup_window` seconds of each other are emitted once. Lines repeated by
+    a single rank are always emitted. At most `dedup_size` distinct lines are
+    remembered.
+
+    Emitted records have `rank` and `process` attributes, so the format
+    string may include `%(rank)s`. Typical usage is
+
+        collector = RankLogCollector(handlers=[logging.StreamHandler()])
+        collector.start()
+        # pass collector.address to the ranks, then in each of them:
+        enable_confidential_logging(
+            handlers=[RankForwardingHandler(address)], force=True
+        )
+    """
+
+    def __init__(
+        self,
+        handlers: list,
+        address=None,
+        authkey: bytes = None,
+        dedup_size: int = 1024,
+        dedup_window: float = 5.0,
+    ):
+        self.handlers = handlers
+        self.authkey = authkey
+        self.dedup_size = dedup_size
+        self.dedup_window = dedup_window
+        self._listener = Listener(address, authkey=authkey)
+        self.address = self._listener.address
+        self._lock = threading.Lock()
+        self._seen = OrderedDict()
+        self._closed = False
+        self._drained = threading.Event()
+        self._threads = []
+        self._acceptor = None
+
+    def start(self) -> None:
+        self._acceptor = threading.Thread(target=self._accept, daemon=True)
+        self._acceptor.start()
+
+    def close(self) -> None:
+        """
+        Stop accepting connections, then wait for connected ranks to close
+        their handlers and flush `handlers`.
+        """
+        # Connections are accepted in order, so once this sentinel is
+        # received every rank which connected before is being served.
+        with Client(self.address, authkey=self.authkey) as connection:
+            connection.send(None)
+        self._drained.wait()
+        self._closed = True
+        # Wake up the blocking `accept` call.
+        Client(self.address, authkey=self.authkey).close()
+        self._acceptor.join()
+        self._listener.close()
+        for thread in self._threads:
+            thread.join()
+        for handler in self.handlers:
+            handler.flush()
+
+    def _accept(self):
+        while True:
+            try:
+                connection = self._listener.accept()
+            except (AuthenticationError, OSError):
+                continue
+            if self._closed:
+                connection.close()
+                return
+            thread = threading.Thread(
+                target=self._receive, args=(connection,), daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def _receive(self, connection):
+        with connection:
+            while True:
+                try:
+                    batch = connection.recv()
+                except EOFError:
+                    return
+                if batch is None:
+                    self._drained.set()
+                    return
+                with self._lock:
+                    for fields in batch:
+                        self._emit(fields)
+
+    def _emit(self, fields):
+        key = (fields["name"], fields["levelno"], fields["category"], fields["msg"])
+        rank = fields.get("rank")
+        now = time.monotonic()
+        # Lines are kept in the order they were first seen, so expired ones
+        # are at the start.
+        while self._seen:
+            first_seen, _ = next(iter(self._seen.values()))
+            if now - first_seen <= self.dedup_window:
+                break
+            self._seen.popitem(last=False)
+
+        seen = self._seen.get(key)
+        if seen is not None and rank not in seen[1]:
+            # The same line from another rank.
+            seen[1].add(rank)
+            return
+        # A new line, or a line repeated by the same rank: emit it, and
+        # start a new window.
+        self._seen.pop(key, None)
+        self._seen[key] = (now, {rank})
+        if len(self._seen) > self.dedup_size:
+            self._seen.popitem(last=False)
+
+        record = logging.makeLogRecord(fields)
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
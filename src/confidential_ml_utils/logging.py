@@ -6,15 +6,70 @@ Utilities around logging data which may or may not contain private content.
 """
 
 
+import asyncio
+import atexit
+from collections import deque
 from confidential_ml_utils.constants import DataCategory
+from confidential_ml_utils.exceptions import format_scrubbed_exception
+import functools
+import io
+import itertools
 import logging
 from logging import DEBUG, INFO, WARNING, ERROR, CRITICAL
-from threading import Lock
+from logging.handlers import QueueHandler, QueueListener
+import os
+import queue
+import sys
+import threading
+from threading import Lock, local
+import time
+import traceback
+from typing import Callable
 import warnings
+import weakref
+
+try:
+    from contextvars import ContextVar
+except ImportError:  # Python 3.6
+
+    class ContextVar:
+        """
+        Minimal thread-local stand-in for `contextvars.ContextVar`. Unlike the
+        real one, it does not isolate asyncio tasks running on the same thread.
+        """
+
+        def __init__(self, name: str, default=None):
+            self._local = local()
+            self._default = default
+
+        def get(self):
+            return getattr(self._local, "value", self._default)
+
+        def set(self, value):
+            token = self.get()
+            self._local.value = value
+            return token
+
+        def reset(self, token):
+            self._local.value = token
 
 
 _LOCK = Lock()
 _PREFIX = None
+_LISTENER = None
+_PUBLIC_ONLY = False
+# Calls dropped by `public_only`, counted without a lock since `next` on an
+# `itertools.count` is atomic. Reading it with `next` counts one more, so
+# reads are counted too.
+_DROPPED_PRIVATE = itertools.count()
+_DROPPED_PRIVATE_READS = 0
+_STATS = None
+_STACK_TRACE = None
+_CONTEXT_PREFIX = ContextVar("confidential_ml_utils_prefix", default=None)
+# Tokens of the `PrefixScope`s entered in the current context, innermost last.
+_CONTEXT_PREFIX_TOKENS = ContextVar("confidential_ml_utils_prefix_tokens", default=())
+
+OVERFLOW_POLICIES = ("block", "drop-oldest", "drop-private-first")
 
 
 def set_prefix(prefix: str) -> None:
@@ -30,18 +85,202 @@ def set_prefix(prefix: str) -> None:
 
 def get_prefix() -> str:
     """
-    Obtain the current global prefix to use when logging public (non-private)
-    data.
+    Obtain the current prefix to use when logging public (non-private) data:
+    the one of the innermost active `PrefixScope`, or the global prefix if
+    there is none.
+    """
+    prefix = _CONTEXT_PREFIX.get()
+    return _PREFIX if prefix is None else prefix
+
+
+class PrefixScope:
+    """
+    Context manager and decorator which overrides the prefix used when logging
+    public data, for the current thread or asyncio task only. This allows
+    several jobs running in the same process to log with different prefixes,
+    e.g.
+
+        with PrefixScope("JobA:"):
+            logger.info("public data", category=DataCategory.PUBLIC)
+
+        @PrefixScope("JobB:")
+        async def score(batch):
+            ...
+
+    The same scope object may be entered from several threads or tasks at
+    once. On Python 3.6, where `contextvars` is not available, the prefix is
+    only isolated between threads, not between asyncio tasks.
+    """
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+
+    def __enter__(self):
+        token = _CONTEXT_PREFIX.set(self.prefix)
+        _CONTEXT_PREFIX_TOKENS.set(_CONTEXT_PREFIX_TOKENS.get() + (token,))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        tokens = _CONTEXT_PREFIX_TOKENS.get()
+        _CONTEXT_PREFIX_TOKENS.set(tokens[:-1])
+        _CONTEXT_PREFIX.reset(tokens[-1])
+
+    def __call__(self, function) -> Callable:
+        # Each call gets its own scope, so the decorated function may run
+        # concurrently in several threads or tasks.
+        if asyncio.iscoroutinefunction(function):
+
+            @functools.wraps(function)
+            async def async_wrapper(*func_args, **func_kwargs):
+                with PrefixScope(self.prefix):
+                    return await function(*func_args, **func_kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*func_args, **func_kwargs):
+            with PrefixScope(self.prefix):
+                return function(*func_args, **func_kwargs)
+
+        return wrapper
+
+
+def get_dropped_private_count() -> int:
+    """
+    Number of `PRIVATE` log calls discarded since the last call to
+    `enable_confidential_logging` with `public_only=True`.
     """
-    return _PREFIX
+    global _DROPPED_PRIVATE_READS
+    with _LOCK:
+        count = next(_DROPPED_PRIVATE) - _DROPPED_PRIVATE_READS
+        _DROPPED_PRIVATE_READS += 1
+    return count
+
+
+class _LoggingStats:
+    """
+    Counters and timings of confidential logging. Only updated while
+    statistics are enabled (see `enable_confidential_logging`).
+    """
+
+    def __init__(self, summary_interval: float):
+        self.summary_interval = summary_interval
+        self._lock = Lock()
+        self._records = {}
+        self._bytes = {}
+        self._dropped = {}
+        self._log_seconds = 0.0
+        self._handler_seconds = 0.0
+        self._last_summary = time.monotonic()
+        self._local = local()
+
+    def count_record(self, record, elapsed: float) -> None:
+        message = getattr(record, "message", None) or record.getMessage()
+        size = len(message.encode("utf-8", "backslashreplace"))
+        key = (record.category.name, record.levelname)
+        with self._lock:
+            self._records[key] = self._records.get(key, 0) + 1
+            self._bytes[key] = self._bytes.get(key, 0) + size
+            self._handler_seconds += elapsed
+
+    def count_log_call(self, elapsed: float) -> None:
+        with self._lock:
+            self._log_seconds += elapsed
+
+    def count_dropped(self, reason: str) -> None:
+        with self._lock:
+            self._dropped[reason] = self._dropped.get(reason, 0) + 1
+
+    def maybe_log_summary(self) -> None:
+        """
+        Log a summary if the last one is older than `summary_interval`.
+        """
+        if not self.summary_interval or getattr(self._local, "logging", False):
+            return
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_summary < self.summary_interval:
+                return
+            self._last_summary = now
+        self._local.logging = True
+        try:
+            logging.getLogger("confidential_ml_utils").info(
+                self.summary(), category=DataCategory.PUBLIC
+            )
+        finally:
+            self._local.logging = False
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            rv = {
+                "records": {},
+                "bytes": {},
+                "log_seconds": self._log_seconds,
+                "handler_seconds": self._handler_seconds,
+                "dropped": dict(self._dropped),
+            }
+            for (category, level), count in self._records.items():
+                rv["records"].setdefault(category, {})[level] = count
+                rv["bytes"].setdefault(category, {})[level] = self._bytes[
+                    (category, level)
+                ]
+        rv["dropped"]["public_only"] = get_dropped_private_count()
+        return rv
+
+    def summary(self) -> str:
+        snapshot = self.snapshot()
+        parts = []
+        for category in DataCategory:
+            records = snapshot["records"].get(category.name, {})
+            size = snapshot["bytes"].get(category.name, {})
+            parts.append(
+                f"{category.name} {sum(records.values())} records "
+                f"({sum(size.values())} bytes)"
+            )
+        return (
+            f"Logging statistics: {', '.join(parts)}, "
+            f"{snapshot['log_seconds']:.3f}s in logging calls, "
+            f"{sum(snapshot['dropped'].values())} records dropped"
+        )
+
+
+def _count_dropped(reason: str) -> None:
+    stats = _STATS
+    if stats is not None:
+        stats.count_dropped(reason)
+
+
+def get_logging_stats() -> dict:
+    """
+    Snapshot of the statistics collected since `enable_confidential_logging`
+    was called with `collect_stats=True`, or `None` if they are not collected.
+    The snapshot has keys:
+    - "records", "bytes": number of records and of message bytes, keyed by
+      data category name then level name.
+    - "log_seconds": time spent in logging calls, including handlers.
+    - "handler_seconds": time spent in the handlers.
+    - "dropped": number of dropped records, keyed by reason.
+    """
+    stats = _STATS
+    return None if stats is None else stats.snapshot()
+
+
+_LEVEL_METHODS = ("debug", "info", "warning", "error", "critical")
+
+# Confidential loggers currently shadowing some logging methods with `_noop`.
+_NOOP_LOGGERS = weakref.WeakSet()
+
+
+def _noop(*args, **kwargs) -> None:
+    pass
 
 
 class ConfidentialLogger(logging.getLoggerClass()):
     """
     Subclass of the default logging class with an explicit `category` parameter
     on all logging methods. It will pass an `extra` param with `prefix` key
-    (value depending on whether `category` is public or private) to the
-    handlers.
+    (value depending on whether `category` is public or private) and
+    `category` key to the handlers.
 
     The default value for data `category` is `PRIVATE` for all methods.
 
@@ -52,13 +291,96 @@ class ConfidentialLogger(logging.getLoggerClass()):
     def __init__(self, name: str):
         super(ConfidentialLogger, self).__init__(name)
 
+    def _disable_method(self, name: str, level: int) -> None:
+        """
+        Shadow the logging method `name` with a no-op on this instance, so
+        further calls skip the level check entirely. The no-ops are removed
+        whenever the confidential logger manager clears its level caches, so
+        this is only done while that manager is installed (Python 3.7+, where
+        level changes clear the caches).
+        """
+        if not isinstance(self.manager, _ConfidentialManager):
+            return
+        if not hasattr(logging.Manager, "_clear_cache"):  # Python 3.6
+            return
+        with logging._lock:
+            if not self.disabled and not self.isEnabledFor(level):
+                setattr(self, name, _noop)
+                _NOOP_LOGGERS.add(self)
+
+    def _enable_methods(self) -> None:
+        # Loggers outside `loggerDict` are skipped by `Manager._clear_cache`.
+        self._cache.clear()
+        for name in _LEVEL_METHODS:
+            self.__dict__.pop(name, None)
+
+    def findCaller(self, stack_info=False, stacklevel=1):
+        """
+        Same as `logging.Logger.findCaller`, but also skips the frames of this
+        module, so records point at the code calling the confidential logger.
+        """
+        f = sys._getframe(1)
+        while f is not None:
+            filename = os.path.normcase(f.f_code.co_filename)
+            if filename not in (logging._srcfile, _SRCFILE):
+                stacklevel -= 1
+                if stacklevel < 1:
+                    break
+            f = f.f_back
+        if f is None:
+            return "(unknown file)", 0, "(unknown function)", None
+        sinfo = None
+        if stack_info:
+            sio = io.StringIO()
+            sio.write("Stack (most recent call last):\n")
+            traceback.print_stack(f, file=sio)
+            sinfo = sio.getvalue().rstrip("\n")
+        return f.f_code.co_filename, f.f_lineno, f.f_code.co_name, sinfo
+
     def _log(self, level, msg, category, args, **kwargs):
+        if _PUBLIC_ONLY and category != DataCategory.PUBLIC:
+            # Return before the record is built or `msg % args` is computed.
+            next(_DROPPED_PRIVATE)
+            return
         p = ""
         if category == DataCategory.PUBLIC:
             p = get_prefix()
+        stats = _STATS
+        if stats is None:
+            super(ConfidentialLogger, self)._log(
+                level, msg, args, extra={"prefix": p, "category": category}, **kwargs
+            )
+            return
+
+        start = time.perf_counter()
         super(ConfidentialLogger, self)._log(
-            level, msg, args, extra={"prefix": p}, **kwargs
+            level, msg, args, extra={"prefix": p, "category": category}, **kwargs
         )
+        stats.count_log_call(time.perf_counter() - start)
+        stats.maybe_log_summary()
+
+    def makeRecord(self, *args, **kwargs):
+        record = super(ConfidentialLogger, self).makeRecord(*args, **kwargs)
+        if (
+            record.exc_info
+            and record.exc_info[0] is not None
+            and getattr(record, "category", None) == DataCategory.PUBLIC
+        ):
+            # Pre-formatting `exc_text` makes every formatter use the scrubbed
+            # text, and dropping `exc_info` keeps handlers from reading the
+            # original exception.
+            record.exc_text = _format_public_exception(record.exc_info, record.prefix)
+            record.exc_info = None
+        return record
+
+    def callHandlers(self, record):
+        stats = _STATS
+        if stats is None or not hasattr(record, "category"):
+            super(ConfidentialLogger, self).callHandlers(record)
+            return
+        start = time.perf_counter()
+        super(ConfidentialLogger, self).callHandlers(record)
+        stats.count_record(record, time.perf_counter() - start)
 
     def debug(
         self, msg: str, category: DataCategory = DataCategory.PRIVATE, *args, **kwargs
@@ -73,6 +395,8 @@ class ConfidentialLogger(logging.getLoggerClass()):
         """
         if self.isEnabledFor(DEBUG):
             self._log(DEBUG, msg, category, args, **kwargs)
+        else:
+            self._disable_method("debug", DEBUG)
 
     def info(
         self, msg: str, category: DataCategory = DataCategory.PRIVATE, *args, **kwargs
@@ -87,6 +411,8 @@ class ConfidentialLogger(logging.getLoggerClass()):
         """
         if self.isEnabledFor(INFO):
             self._log(INFO, msg, category, args, **kwargs)
+        else:
+            self._disable_method("info", INFO)
 
     def warning(
         self, msg: str, category: DataCategory = DataCategory.PRIVATE, *args, **kwargs
@@ -101,6 +427,8 @@ class ConfidentialLogger(logging.getLoggerClass()):
         """
         if self.isEnabledFor(WARNING):
             self._log(WARNING, msg, category, args, **kwargs)
+        else:
+            self._disable_method("warning", WARNING)
 
     def warn(
         self, msg: str, category: DataCategory = DataCategory.PRIVATE, *args, **kwargs
@@ -125,6 +453,8 @@ class ConfidentialLogger(logging.getLoggerClass()):
         """
         if self.isEnabledFor(ERROR):
             self._log(ERROR, msg, category, args, **kwargs)
+        else:
+            self._disable_method("error", ERROR)
 
     def critical(
         self, msg: str, category: DataCategory = DataCategory.PRIVATE, *args, **kwargs
@@ -139,9 +469,372 @@ class ConfidentialLogger(logging.getLoggerClass()):
         """
         if self.isEnabledFor(CRITICAL):
             self._log(CRITICAL, msg, category, args, **kwargs)
+        else:
+            self._disable_method("critical", CRITICAL)
+
+    def exception(
+        self,
+        msg: str,
+        category: DataCategory = DataCategory.PRIVATE,
+        *args,
+        exc_info=True,
+        **kwargs,
+    ):
+        """
+        Log `msg % args` with severity `ERROR`, and the exception currently
+        being handled. For `PUBLIC` records, the stack trace is prefixed and
+        exception messages are scrubbed, see `enable_confidential_logging`.
+        """
+        self.error(msg, category, *args, exc_info=exc_info, **kwargs)
+
+
+_SRCFILE = os.path.normcase(ConfidentialLogger.findCaller.__code__.co_filename)
+
+
+def _format_public_exception(exc_info: tuple, prefix: str) -> str:
+    stack_trace = _STACK_TRACE
+    if stack_trace is None:
+        text = format_scrubbed_exception(exc_info)
+    else:
+        text = format_scrubbed_exception(
+            exc_info,
+            stack_trace.scrub_message,
+            stack_trace.keep_message,
+            stack_trace.allow_list,
+            stack_trace.max_chain_depth,
+            stack_trace.max_frames,
+            stack_trace.fold_repeated_frames,
+            stack_trace.lookup_lines,
+        )
+    return "\n".join(f"{prefix} {line}" for line in text.splitlines())
+
+
+class _ConfidentialManager(logging.Manager):
+    """
+    Logger manager which also resets the no-op logging methods of confidential
+    loggers when levels change (`setLevel`, `logging.disable`, ...), including
+    loggers which were not created through `logging.getLogger`.
+    """
+
+    def _clear_cache(self):
+        super(_ConfidentialManager, self)._clear_cache()
+        with logging._lock:
+            for logger in list(_NOOP_LOGGERS):
+                logger._enable_methods()
+            _NOOP_LOGGERS.clear()
+
+
+class CategoryRoutingHandler(logging.Handler):
+    """
+    Handler which forwards each record to the handler registered for its
+    data category, e.g.
+
+        CategoryRoutingHandler({
+            DataCategory.PUBLIC: logging.StreamHandler(),
+            DataCategory.PRIVATE: logging.FileHandler("private.log"),
+        })
+
+    Records whose category has no handler are dropped. Records which do not
+    carry a category (i.e. not logged through a `ConfidentialLogger`) are
+    treated as `PRIVATE`.
+    """
+
+    def __init__(self, routes: dict, level=logging.NOTSET):
+        super(CategoryRoutingHandler, self).__init__(level)
+        self.routes = dict(routes)
+
+    def emit(self, record):
+        category = getattr(record, "category", DataCategory.PRIVATE)
+        handler = self.routes.get(category)
+        if handler is not None and record.levelno >= handler.level:
+            handler.handle(record)
+
+    def setFormatter(self, fmt):
+        # Allows `logging.basicConfig(handlers=[...], format=...)` to
+        # configure the handlers which actually format the records.
+        super(CategoryRoutingHandler, self).setFormatter(fmt)
+        for handler in self.routes.values():
+            if handler is not None and handler.formatter is None:
+                handler.setFormatter(fmt)
+
+    def flush(self):
+        for handler in self.routes.values():
+            if handler is not None:
+                handler.flush()
+
+    def close(self):
+        for handler in self.routes.values():
+            if handler is not None:
+                handler.close()
+        super(CategoryRoutingHandler, self).close()
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Filter which lets at most `public_limit` (resp. `private_limit`) `PUBLIC`
+    (resp. `PRIVATE`) records through per call site (file and line number)
+    every `interval` seconds. A limit of `None` means no limit. The first
+    record let through after some were suppressed is suffixed with
+    "[message repeated N times]". If a call site stops logging, the number of
+    records it had suppressed is reported by the "confidential_ml_utils"
+    logger once its window has ended, or when `close` is called.
+
+    Decisions are stored on the record, so the same filter may be added to
+    several handlers.
+    """
+
+    def __init__(
+        self,
+        public_limit: int = None,
+        private_limit: int = None,
+        interval: float = 60.0,
+    ):
+        super(RateLimitFilter, self).__init__()
+        self.limits = {
+            DataCategory.PUBLIC: public_limit,
+            DataCategory.PRIVATE: private_limit,
+        }
+        self.interval = interval
+        self._sites = {}
+        self._last_sweep = None
+        self._lock = Lock()
+
+    def filter(self, record):
+        allowed = getattr(record, "rate_limit_allowed", None)
+        if allowed is not None:
+            return allowed
+        category = getattr(record, "category", DataCategory.PRIVATE)
+        limit = self.limits.get(category)
+        suppressed = 0
+        ended = []
+        if limit is None:
+            allowed = True
+        else:
+            key = (record.pathname, record.lineno, category)
+            with self._lock:
+                # [window start, records let through, records suppressed, level]
+                site = self._sites.get(key)
+                if site is None or record.created - site[0] >= self.interval:
+                    if site is not None:
+                        suppressed = site[2]
+                    site = self._sites[key] = [record.created, 0, 0, record.levelno]
+                allowed = site[1] < limit
+                if allowed:
+                    site[1] += 1
+                else:
+                    site[2] += 1
+                    site[3] = record.levelno
+                    _count_dropped("rate_limited")
+                if self._last_sweep is None:
+                    self._last_sweep = record.created
+                elif record.created - self._last_sweep >= self.interval:
+                    self._last_sweep = record.created
+                    ended = self._pop_sites(record.created - self.interval)
+        if suppressed:
+            record.msg = f"{record.getMessage()} [message repeated {suppressed} times]"
+            record.args = None
+        record.rate_limit_allowed = allowed
+        self._report(ended)
+        return allowed
+
+    def close(self) -> None:
+        """
+        Report the number of records suppressed in the current windows, and
+        forget all call sites.
+        """
+        with self._lock:
+            ended = self._pop_sites(float("inf"))
+            self._last_sweep = None
+        self._report(ended)
+
+    def _pop_sites(self, started_before: float) -> list:
+        """
+        Remove the call sites whose window started before `started_before`,
+        and return those which suppressed records. Call with `_lock` held.
+        """
+        ended = []
+        for key, site in list(self._sites.items()):
+            if site[0] <= started_before:
+                del self._sites[key]
+                if site[2]:
+                    ended.append((key, site))
+        return ended
+
+    def _report(self, ended: list) -> None:
+        logger = logging.getLogger("confidential_ml_utils")
+        for (pathname, lineno, category), site in ended:
+            level = site[3]
+            if not logger.isEnabledFor(level):
+                continue
+            extra = {
+                "prefix": get_prefix() if category == DataCategory.PUBLIC else "",
+                "category": category,
+                "rate_limit_allowed": True,
+            }
+            message = (
+                f"{site[2]} records suppressed by the rate limit at "
+                f"{os.path.basename(pathname)}:{lineno}"
+            )
+            logger.handle(
+                logger.makeRecord(
+                    logger.name,
+                    level,
+                    pathname,
+                    lineno,
+                    message,
+                    None,
+                    None,
+                    extra=extra,
+                )
+            )
+
+
+class _RecordQueue(queue.Queue):
+    """
+    Bounded queue of log records which, instead of blocking producers when it
+    is full, can evict an already-enqueued record to make room for a new one.
+
+    `PRIVATE` records are kept apart from the others, each with a sequence
+    number, so that both the oldest record and the oldest `PRIVATE` record
+    can be dequeued in constant time.
+    """
 
+    def _init(self, maxsize):
+        self._sequence = itertools.count()
+        self._private = deque()
+        self._other = deque()
 
-def enable_confidential_logging(prefix: str = "SystemLog:", **kwargs) -> None:
+    def _qsize(self):
+        return len(self._private) + len(self._other)
+
+    def _put(self, record):
+        if getattr(record, "category", None) == DataCategory.PRIVATE:
+            self._private.append((next(self._sequence), record))
+        else:
+            self._other.append((next(self._sequence), record))
+
+    def _get(self):
+        return self._oldest().popleft()[1]
+
+    def _oldest(self) -> deque:
+        if not self._private:
+            return self._other
+        if not self._other:
+            return self._private
+        return self._private if self._private[0] < self._other[0] else self._other
+
+    @property
+    def queue(self) -> list:
+        """
+        Queued records, oldest first.
+        """
+        return [record for _, record in sorted(self._private + self._other)]
+
+    def put_evicting(self, record, private_first: bool) -> None:
+        with self.not_full:
+            if 0 < self.maxsize <= self._qsize():
+                if private_first and self._private:
+                    self._private.popleft()
+                else:
+                    self._oldest().popleft()
+                # The evicted record will never be marked as done by the
+                # listener, so account for it here.
+                self.unfinished_tasks -= 1
+                _count_dropped("queue_overflow")
+            self._put(record)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+
+class _ConfidentialQueueHandler(QueueHandler):
+    """
+    Queue handler which hands records to the background listener untouched:
+    the `prefix` extra is already resolved by `ConfidentialLogger._log`, and
+    message interpolation and formatting happen on the listener thread.
+    """
+
+    def __init__(
+        self,
+        record_queue: _RecordQueue,
+        overflow: str,
+        listener: "_ConfidentialQueueListener" = None,
+    ):
+        super(_ConfidentialQueueHandler, self).__init__(record_queue)
+        self.overflow = overflow
+        self.listener = listener
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        listener = self.listener
+        if listener is not None and threading.current_thread() is listener._thread:
+            # Logged by a handler or filter of the listener (e.g. the report
+            # of a `RateLimitFilter`): waiting on the queue could deadlock.
+            self.listener.handle(record)
+        elif self.overflow == "block":
+            self.queue.put(record)
+        else:
+            self.queue.put_evicting(record, self.overflow == "drop-private-first")
+
+
+class _ConfidentialQueueListener(QueueListener):
+    def enqueue_sentinel(self):
+        # The stdlib implementation uses `put_nowait`, which fails on a full
+        # bounded queue.
+        self.queue.put(self._sentinel)
+
+
+def _stop_queue_listener() -> None:
+    """
+    Flush all queued records through the original handlers, stop the
+    background listener thread and restore those handlers on the root logger.
+    Does nothing if asynchronous logging is not enabled.
+    """
+    global _LISTENER
+    with _LOCK:
+        listener, _LISTENER = _LISTENER, None
+    if listener is None:
+        return
+    listener.stop()
+    root = logging.getLogger()
+    handlers = []
+    for handler in root.handlers:
+        if isinstance(handler, _ConfidentialQueueHandler):
+            handlers.extend(listener.handlers)
+        else:
+            handlers.append(handler)
+    root.handlers = handlers
+
+
+atexit.register(_stop_queue_listener)
+
+
+def _start_queue_listener(queue_size: int, overflow: str) -> None:
+    global _LISTENER
+    root = logging.getLogger()
+    record_queue = _RecordQueue(queue_size)
+    listener = _ConfidentialQueueListener(
+        record_queue, *root.handlers, respect_handler_level=True
+    )
+    root.handlers = [_ConfidentialQueueHandler(record_queue, overflow, listener)]
+    with _LOCK:
+        _LISTENER = listener
+    listener.start()
+
+
+def enable_confidential_logging(
+    prefix: str = "SystemLog:",
+    use_queue: bool = False,
+    queue_size: int = 10000,
+    overflow: str = "block",
+    public_only: bool = False,
+    rate_limit: RateLimitFilter = None,
+    collect_stats: bool = False,
+    stats_interval: float = 0,
+    stack_trace=None,
+    **kwargs,
+) -> None:
     """
     The default format is `logging.BASIC_FORMAT` (`%(levelname)s:%(name)s:%(message)s`).
     All other kwargs are passed to `logging.basicConfig`. Sets the default
@@ -150,6 +843,40 @@ def enable_confidential_logging(prefix: str = "SystemLog:", **kwargs) -> None:
 
     Set the format using the `format` kwarg.
 
+    If `use_queue` is True, records are put on a bounded queue of size
+    `queue_size` and a background thread formats and writes them through the
+    configured handlers, so logging calls do not wait on I/O. Message
+    arguments are interpolated on that thread, so do not mutate them after
+    logging. When the queue is full, `overflow` decides what happens:
+    - "block": wait for space in the queue.
+    - "drop-oldest": discard the oldest queued record.
+    - "drop-private-first": discard the oldest queued `PRIVATE` record, or
+      the oldest record if there is none.
+    Queued records are flushed at interpreter exit, or when this method is
+    called again.
+
+    If `public_only` is True, log calls with a `PRIVATE` category are
+    discarded before any record is created. This is useful in environments
+    where only prefixed lines are kept. The number of discarded calls is
+    available via `get_dropped_private_count`.
+
+    If `rate_limit` is provided, that `RateLimitFilter` is added to the
+    handlers of the root logger.
+
+    If `collect_stats` is True, the number of records and bytes per data
+    category and level, the time spent logging and the number of dropped
+    records are collected, see `get_logging_stats`. If `stats_interval` is
+    positive, a `PUBLIC` summary of these statistics is also logged at `INFO`
+    level by the "confidential_ml_utils" logger at most every `stats_interval`
+    seconds.
+
+    Exceptions logged with a `PUBLIC` category (e.g. with
+    `logger.exception("failed", category=DataCategory.PUBLIC)`) have their
+    stack trace prefixed and their messages scrubbed, with the options (allow
+    list, scrub message, bounds) of `stack_trace`, a wrapper returned by
+    `confidential_ml_utils.exceptions.prefix_stack_trace`. Stack traces of
+    `PRIVATE` records are left as is.
+
     After calling this method, use the kwarg `category` to pass in a value of
     `DataCategory` to denote data category. The default is `PRIVATE`. That is,
     if no changes are made to an existing set of log statements, the log output
@@ -158,8 +885,28 @@ def enable_confidential_logging(prefix: str = "SystemLog:", **kwargs) -> None:
     The standard implementation of the logging API is a good reference:
     https://github.com/python/cpython/blob/3.9/Lib/logging/__init__.py
     """
+    if overflow not in OVERFLOW_POLICIES:
+        raise ValueError(
+            f"Unknown overflow policy {overflow!r}, "
+            f"expected one of {OVERFLOW_POLICIES}"
+        )
+
+    _stop_queue_listener()
+    for handler in logging.getLogger().handlers:
+        for f in handler.filters:
+            if isinstance(f, RateLimitFilter):
+                f.close()
     set_prefix(prefix)
 
+    global _PUBLIC_ONLY, _DROPPED_PRIVATE, _DROPPED_PRIVATE_READS, _STATS
+    global _STACK_TRACE
+    with _LOCK:
+        _PUBLIC_ONLY = public_only
+        _STACK_TRACE = stack_trace
+        _DROPPED_PRIVATE = itertools.count()
+        _DROPPED_PRIVATE_READS = 0
+        _STATS = _LoggingStats(stats_interval) if collect_stats else None
+
     if "format" not in kwargs:
         kwargs["format"] = f"%(prefix)s{logging.BASIC_FORMAT}"
 
@@ -174,7 +921,17 @@ def enable_confidential_logging(prefix: str = "SystemLog:", **kwargs) -> None:
 
     logging.root = root
     logging.Logger.root = root
-    logging.Logger.manager = logging.Manager(root)
+    logging.Logger.manager = _ConfidentialManager(root)
 
     # https://github.com/kivy/kivy/issues/6733
     logging.basicConfig(**kwargs)
+
+    for handler in root.handlers:
+        for f in list(handler.filters):
+            if isinstance(f, RateLimitFilter):
+                handler.removeFilter(f)
+        if rate_limit:
+            handler.addFilter(rate_limit)
+
+    if use_queue:
+        _start_queue_listener(queue_size, overflow)
@@ -1,9 +1,14 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT license.
 
-import glob
+from concurrent.futures import ProcessPoolExecutor
+from fnmatch import fnmatchcase
+import json
+import mmap
 import os
 import re
+import sys
+import threading
 from confidential_ml_utils.exceptions import print_prefixed_stack_trace_and_raise
 
 
@@ -19,6 +24,10 @@ class StackTraceExtractor:
         True to extract exception messages. False to skip them.
     prefix : bool
         Prefix to prepend extracted lines with. Defaults to "SystemLog".
+    use_mmap : bool
+        True to memory-map files and only decode the lines around stack trace
+        anchors, tolerating invalid UTF-8. Faster on large files made mostly
+        of other lines.
 
     Methods
     -------
@@ -26,104 +35,431 @@ class StackTraceExtractor:
         Extracts traces and exceptions from file to stdout.
     """
 
+    _PYTHON_TRACEBACK = "Traceback (most recent call last):"
+    _PYTHON_FRAME = re.compile(
+        r"File (?P<file>.*), line (?P<line>\d*), in (?P<method>.*)"
+    )
+    _PYTHON_EXCEPTION = re.compile(r"(?P<type>.*Error): (?P<message>.*)")
+    _CSHARP_FRAME = re.compile(
+        r"at (?P<namespace>.*)\.(?P<class>.*)\.(?P<method>.*) in (?P<file>.*):line (?P<line>\d*)"  # noqa:501
+    )
+    _CSHARP_EXCEPTION = re.compile(
+        r"Unhandled exception. (?P<type>.*): (?P<message>.*)"
+    )
+    # Any line matched by one of the patterns above contains one of these
+    # literals, so other lines (the vast majority) skip the patterns entirely.
+    _ANCHORS = re.compile(r"Traceback|File |Error: |:line |Unhandled exception")
+    _BYTES_ANCHORS = re.compile(rb"Traceback|File |Error: |:line |Unhandled exception")
+
     def __init__(
         self,
         show_exception_message: bool = False,
         prefix: str = "SystemLog",
+        use_mmap: bool = False,
     ):
         self.in_python_traceback = False
         self.show_exception_message = show_exception_message
         self.prefix = prefix
+        self.use_mmap = use_mmap
 
     def _parse_trace_python(self, string: str):
-        r = re.compile(r"Traceback \(most recent call last\):")
-        m = r.search(string)
-        if m:
+        if StackTraceExtractor._PYTHON_TRACEBACK in string:
             self.in_python_traceback = True
             return None
 
-        r = re.compile(r"File (?P<file>.*), line (?P<line>\d*), in (?P<method>.*)")
-        m = r.search(string)
-        if m:
-            return m
+        if "File " in string:
+            m = StackTraceExtractor._PYTHON_FRAME.search(string)
+            if m:
+                return m
 
-        r = re.compile(r"(?P<type>.*Error): (?P<message>.*)")
-        m = r.search(string)
-        if m and self.in_python_traceback:
-            self.in_python_traceback = False
-            return m
+        if self.in_python_traceback and "Error: " in string:
+            m = StackTraceExtractor._PYTHON_EXCEPTION.search(string)
+            if m:
+                self.in_python_traceback = False
+                return m
 
         return None
 
     @staticmethod
     def _parse_trace_csharp(string: str):
-        r = re.compile(
-            r"at (?P<namespace>.*)\.(?P<class>.*)\.(?P<method>.*) in (?P<file>.*):line (?P<line>\d*)"  # noqa:501
-        )
-        m = r.search(string)
-        if m:
-            return m
-
-        r = re.compile(r"Unhandled exception. (?P<type>.*): (?P<message>.*)")
-        m = r.search(string)
-        if m:
-            return m
+        if ":line " in string:
+            m = StackTraceExtractor._CSHARP_FRAME.search(string)
+            if m:
+                return m
+
+        if "Unhandled exception" in string:
+            m = StackTraceExtractor._CSHARP_EXCEPTION.search(string)
+            if m:
+                return m
 
         return None
 
+    def _parse_line(self, line: str) -> list:
+        """
+        Lines to print for `line`, an empty list if it is not part of a stack
+        trace.
+        """
+        if not StackTraceExtractor._ANCHORS.search(line):
+            return []
+        rv = []
+
+        m = StackTraceExtractor._parse_trace_csharp(line)
+        if m and m.groupdict().get("type"):
+            rv.append(f"{self.prefix}: type: {m.groupdict()['type']}")
+            if self.show_exception_message:
+                rv.append(f"{self.prefix}: message: {m.groupdict()['message']}")
+            return rv
+
+        elif m and m.groupdict().get("namespace"):
+            rv.append(f"{self.prefix}: namespace: {m.groupdict()['namespace']}")
+            rv.append(f"{self.prefix}: class: {m.groupdict()['class']}")
+            rv.append(f"{self.prefix}: method: {m.groupdict()['method']}")
+            rv.append(f"{self.prefix}: file: {m.groupdict()['file']}")
+            rv.append(f"{self.prefix}: line: {m.groupdict()['line']}")
+            rv.append("")
+            return rv
+
+        m = self._parse_trace_python(line)
+        if m and m.groupdict().get("type"):
+            rv.append(f"{self.prefix}: type: {m.groupdict()['type']}")
+            if self.show_exception_message:
+                rv.append(f"{self.prefix}: message: {m.groupdict()['message']}")
+                rv.append("")
+        elif m and m.groupdict().get("file"):
+            rv.append(f"{self.prefix}: file: {m.groupdict()['file']}")
+            rv.append(f"{self.prefix}: line: {m.groupdict()['line']}")
+            rv.append(f"{self.prefix}: method: {m.groupdict()['method']}")
+        return rv
+
+    @staticmethod
+    def _scan_lines(file: str, offset: int = 0, size: int = None):
+        """
+        Yield the lines of `file` between byte offsets `offset` and `size`
+        (by default, its end) which contain a stack trace anchor, without
+        decoding the others, with the offset where each line ends. Invalid
+        UTF-8 is replaced.
+        """
+        with open(file, "rb") as f:
+            if size is None:
+                size = os.fstat(f.fileno()).st_size
+            if size <= offset:
+                return
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+                pos = offset
+                while True:
+                    m = StackTraceExtractor._BYTES_ANCHORS.search(mm, pos, size)
+                    if not m:
+                        return
+                    start = mm.rfind(b"\n", offset, m.start()) + 1 or offset
+                    end = mm.find(b"\n", m.end(), size)
+                    end = size if end < 0 else end + 1
+                    line = mm[start:end].rstrip(b"\r\n")
+                    yield line.decode("utf-8", "replace"), end
+                    pos = end
+
+    @staticmethod
+    def _read_lines(file: str, offset: int, size: int, max_line_length: int = -1):
+        """
+        Yield the lines of `file` between byte offsets `offset` and `size`,
+        with the offset where each line ends. Invalid UTF-8 is replaced.
+        Lines longer than `max_line_length` bytes, if provided, are split.
+        """
+        with open(file, "rb") as f:
+            f.seek(offset)
+            pos = offset
+            for line in iter(lambda: f.readline(max_line_length), b""):
+                if pos >= size:
+                    return
+                line = line[: size - pos]
+                pos += len(line)
+                yield line.rstrip(b"\r\n").decode("utf-8", "replace"), pos
+
+    @staticmethod
+    def _last_line_end(file: str, offset: int, size: int) -> int:
+        """
+        Offset following the last newline of `file` between `offset` and
+        `size`, or `offset` if there is none.
+        """
+        with open(file, "rb") as f:
+            end = size
+            while end > offset:
+                start = max(offset, end - 64 * 1024)
+                f.seek(start)
+                i = f.read(end - start).rfind(b"\n")
+                if i >= 0:
+                    return start + i + 1
+                end = start
+        return offset
+
+    def _file_lines(
+        self, file: str, entry: dict = None, max_partial_line: int = None
+    ) -> tuple:
+        """
+        Lines to print for `file`, and its checkpoint entry. If `entry`, the
+        checkpoint entry of a previous run (or an empty dictionary for a new
+        file), is provided, parsing resumes where that run stopped, and no
+        line is printed if `file` is unchanged.
+        Errors while reading `file` are reported in the printed lines instead
+        of being raised.
+        """
+        rv = [f"{self.prefix}: Parsing file {os.path.abspath(file)}"]
+        self.in_python_traceback = False
+        try:
+            if entry is None and not self.use_mmap:
+                with open(file, "r") as f:
+                    for line in f:
+                        rv.extend(self._parse_line(line))
+                return rv, None
+            return self._parse_from_checkpoint(file, entry, rv, max_partial_line)
+        except Exception as e:
+            rv.append(f"{self.prefix}: Could not parse file: {type(e).__name__}")
+            return rv, entry or None
+
+    def _parse_from_checkpoint(
+        self, file: str, entry: dict, rv: list, max_partial_line: int = None
+    ) -> tuple:
+        """
+        See `_file_lines`. When resuming from `entry`, a last line without
+        newline may still be being written, so it is only parsed once
+        complete, or, if `max_partial_line` is provided, once longer than that
+        many bytes (it is then skipped over, like longer lines).
+        """
+        st = os.stat(file)
+        offset = 0
+        if entry and entry["inode"] == st.st_ino and entry["offset"] <= st.st_size:
+            if entry["size"] == st.st_size and entry["mtime"] == st.st_mtime:
+                return [], entry
+            offset = entry["offset"]
+            self.in_python_traceback = entry["in_python_traceback"]
+        # else: new, truncated or rotated file, parse it from the start.
+
+        size = st.st_size
+        if entry is not None:
+            complete = StackTraceExtractor._last_line_end(file, offset, size)
+            if max_partial_line is None or size - complete <= max_partial_line:
+                size = complete
+        if self.use_mmap:
+            lines = StackTraceExtractor._scan_lines(file, offset, size)
+        else:
+            lines = StackTraceExtractor._read_lines(
+                file, offset, size, max_partial_line or -1
+            )
+        for line, _ in lines:
+            rv.extend(self._parse_line(line))
+        return rv, {
+            "inode": st.st_ino,
+            "size": st.st_size,
+            "mtime": st.st_mtime,
+            "offset": size,
+            "in_python_traceback": self.in_python_traceback,
+        }
+
     def _parse_file(self, file: str) -> None:
-        print(f"{self.prefix}: Parsing file {os.path.abspath(file)}")
-        with open(file, "r") as f:
-            for line in f:
-                m = StackTraceExtractor._parse_trace_csharp(line)
-                if m and m.groupdict().get("type"):
-                    print(f"{self.prefix}: type: {m.groupdict()['type']}")
-                    if self.show_exception_message:
-                        print(f"{self.prefix}: message: {m.groupdict()['message']}")
-                    continue
-
-                elif m and m.groupdict().get("namespace"):
-                    print(f"{self.prefix}: namespace: {m.groupdict()['namespace']}")
-                    print(f"{self.prefix}: class: {m.groupdict()['class']}")
-                    print(f"{self.prefix}: method: {m.groupdict()['method']}")
-                    print(f"{self.prefix}: file: {m.groupdict()['file']}")
-                    print(f"{self.prefix}: line: {m.groupdict()['line']}")
-                    print()
-                    continue
-
-                m = self._parse_trace_python(line)
-                if m and m.groupdict().get("type"):
-                    print(f"{self.prefix}: type: {m.groupdict()['type']}")
-                    if self.show_exception_message:
-                        print(f"{self.prefix}: message: {m.groupdict()['message']}")
-                        print()
-                elif m and m.groupdict().get("file"):
-                    print(f"{self.prefix}: file: {m.groupdict()['file']}")
-                    print(f"{self.prefix}: line: {m.groupdict()['line']}")
-                    print(f"{self.prefix}: method: {m.groupdict()['method']}")
-
-    def _get_files(self, path) -> list:
+        for output in self._file_lines(file)[0]:
+            print(output)
+
+    @staticmethod
+    def _matches(path: str, patterns: list) -> bool:
+        name = os.path.basename(path)
+        return any(fnmatchcase(path, p) or fnmatchcase(name, p) for p in patterns)
+
+    def _find_files(self, path, include: list, exclude: list, recursive: bool) -> list:
+        if os.path.isfile(path):
+            return [path]
+        files = []
+        for root, dirs, names in os.walk(path):
+            relative = os.path.relpath(root, path).replace(os.sep, "/")
+            relative = "" if relative == "." else relative + "/"
+            dirs[:] = [
+                d
+                for d in dirs
+                if not d.startswith(".") and not self._matches(relative + d, exclude)
+            ]
+            for name in names:
+                if (
+                    not name.startswith(".")
+                    and self._matches(relative + name, include)
+                    and not self._matches(relative + name, exclude)
+                ):
+                    files.append(os.path.join(root, name))
+            if not recursive:
+                break
+        return sorted(files)
+
+    def _get_files(
+        self,
+        path,
+        include: list = ["*.err"],
+        exclude: list = [],
+        recursive: bool = False,
+    ) -> list:
         if os.path.isfile(path):
             print(f"{self.prefix}: Input is a file")
             return [path]
         if os.path.isdir(path):
             print(f"{self.prefix}: Input is a directory")
-            files = glob.glob(path + "/*.err")
-            return files
+            return self._find_files(path, include, exclude, recursive)
+
+    @staticmethod
+    def _load_checkpoint(checkpoint: str) -> dict:
+        try:
+            with open(checkpoint, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    @staticmethod
+    def _save_checkpoint(checkpoint: str, entries: dict) -> None:
+        # Write then rename, so an interrupted run leaves the previous
+        # checkpoint intact.
+        with open(checkpoint + ".tmp", "w") as f:
+            json.dump(entries, f)
+        os.replace(checkpoint + ".tmp", checkpoint)
 
-    def extract(self, path: str) -> None:
+    def extract(
+        self,
+        path: str,
+        workers: int = 1,
+        include: list = ["*.err"],
+        exclude: list = [],
+        recursive: bool = False,
+        checkpoint: str = None,
+    ) -> None:
         """
         Run extraction on the given resources. Extracted traces and exceptions
         will be printed to stdout.
         Args:
             path (str): file or path. If path, extraction will be performed on
-            all files with '.err' extension within that directory (not recursive).
-            Hidden files will be ignored.
+            all files matching `include` within that directory. Hidden files
+            and directories will be ignored.
+            workers (int): if greater than 1, files are parsed by that many
+            processes. Output is still printed in file name order, and a file
+            which cannot be read does not stop the extraction of the others.
+            include (list): glob patterns of the files to parse, matched
+            against file names and paths relative to `path`.
+            exclude (list): glob patterns of the files and directories to skip.
+            recursive (bool): if True, also search the subdirectories of
+            `path`.
+            checkpoint (str): if provided, path of a file where the offset
+            reached in each parsed file is saved, so later runs only parse
+            bytes appended since, and skip unchanged files. A last line
+            without newline is then only parsed once a newline is appended.
         """
         try:
-            for file in self._get_files(path):
-                self._parse_file(file)
-            assert False
+            files = self._get_files(path, include, exclude, recursive)
+            keys = [os.path.abspath(file) for file in files]
+            if checkpoint:
+                entries = StackTraceExtractor._load_checkpoint(checkpoint)
+                previous = [entries.get(key, {}) for key in keys]
+            else:
+                previous = [None] * len(files)
+            if workers > 1 and len(files) > 1:
+                executor = ProcessPoolExecutor(max_workers=workers)
+                results = executor.map(self._file_lines, files, previous)
+            else:
+                executor = None
+                results = map(self._file_lines, files, previous)
+            new_entries = {}
+            try:
+                for key, (lines, entry) in zip(keys, results):
+                    for output in lines:
+                        print(output)
+                    if entry is not None:
+                        new_entries[key] = entry
+            finally:
+                if executor:
+                    executor.shutdown()
+            if checkpoint:
+                StackTraceExtractor._save_checkpoint(checkpoint, new_entries)
         except BaseException as e:
             print(f"{self.prefix}: There is a problem with the exceptionExtractor.")
             print_prefixed_stack_trace_and_raise(err=e, keep_message=True)
+
+    @staticmethod
+    def _find_inode(directory: str, inode: int) -> str:
+        for entry in os.scandir(directory):
+            if entry.inode() == inode and entry.is_file():
+                return entry.path
+        return None
+
+    def _poll(
+        self,
+        path: str,
+        include: list,
+        exclude: list,
+        recursive: bool,
+        entries: dict,
+        max_line_length: int,
+    ) -> list:
+        """
+        Lines to print for the complete lines appended to the files of `path`
+        since the previous poll. `entries` holds the checkpoint entry of each
+        file, and is updated.
+        """
+        rv = []
+        current = {}
+        for file in self._find_files(path, include, exclude, recursive):
+            key = os.path.abspath(file)
+            entry = entries.get(key, {})
+            try:
+                if entry and os.stat(file).st_ino != entry["inode"]:
+                    # Rotated: finish the previous file, if it is still there.
+                    rotated = StackTraceExtractor._find_inode(
+                        os.path.dirname(key), entry["inode"]
+                    )
+                    if rotated:
+                        lines = self._file_lines(rotated, entry, max_line_length)[0]
+                        if len(lines) > 1:
+                            rv.extend(lines)
+                    entry = {}
+            except OSError:
+                # Removed since it was found.
+                continue
+            lines, entry = self._file_lines(file, entry, max_line_length)
+            # Only print the name of files with new stack trace lines.
+            if len(lines) > 1:
+                rv.extend(lines)
+            if entry is not None:
+                current[key] = entry
+        # Forget files which disappeared.
+        entries.clear()
+        entries.update(current)
+        return rv
+
+    def follow(
+        self,
+        path: str,
+        interval: float = 1.0,
+        include: list = ["*.err"],
+        exclude: list = [],
+        recursive: bool = False,
+        max_line_length: int = 1024 * 1024,
+        stop: threading.Event = None,
+    ) -> None:
+        """
+        Watch the files of `path` (selected as in `extract`) and print the
+        traces and exceptions of the lines appended to them, checking every
+        `interval` seconds, until `stop` is set or the process is
+        interrupted. Existing content is parsed first.
+        Files created later are picked up, and when a file is rotated (renamed
+        and replaced with a new file), the end of the renamed file is parsed
+        before the new file.
+        Only complete lines are parsed, and only the parser state is kept
+        between checks, so memory use does not depend on the size of files or
+        traces. A line still being written is parsed once longer than
+        `max_line_length` bytes, and, unless `use_mmap` is True, longer lines
+        are parsed in pieces of that size.
+        """
+        entries = {}
+        stop = stop or threading.Event()
+        try:
+            while True:
+                for output in self._poll(
+                    path, include, exclude, recursive, entries, max_line_length
+                ):
+                    print(output)
+                sys.stdout.flush()
+                if stop.wait(interval):
+                    return
+        except KeyboardInterrupt:
+            return
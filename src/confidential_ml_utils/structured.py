@@ -0,0 +1,151 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+Structured (machine-readable) output for confidential logs: JSON lines, and a
+compact length-prefixed binary encoding for high-volume local capture.
+"""
+
+
+from confidential_ml_utils.constants import DataCategory
+import json
+import logging
+import struct
+from typing import Iterator
+
+
+MAGIC = b"CMLULOG1"
+
+# created, levelno, category (0 if unknown)
+_HEADER = struct.Struct("<dHB")
+_LENGTH = struct.Struct("<I")
+
+_DEFAULT_FORMATTER = logging.Formatter()
+
+
+def _record_fields(record: logging.LogRecord, formatter: logging.Formatter) -> dict:
+    """
+    Fields of `record` shared by all structured outputs.
+    """
+    if record.exc_info and not record.exc_text:
+        record.exc_text = formatter.formatException(record.exc_info)
+    category = getattr(record, "category", None)
+    fields = {
+        "created": record.created,
+        "levelname": record.levelname,
+        "name": record.name,
+        "category": category.name if category else None,
+        "prefix": getattr(record, "prefix", ""),
+        "message": record.getMessage(),
+    }
+    if record.exc_text:
+        fields["exc_text"] = record.exc_text
+    return fields
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formatter which renders each record as a single-line JSON object with
+    `created`, `levelname`, `name`, `category`, `prefix`, `message` and, if
+    an exception was logged, `exc_text` keys.
+    """
+
+    def format(self, record):
+        return json.dumps(
+            _record_fields(record, self), separators=(",", ":"), ensure_ascii=False
+        )
+
+
+def encode_record(record: logging.LogRecord, formatter: logging.Formatter) -> bytes:
+    """
+    Encode `record` as a length-prefixed binary frame.
+    """
+    fields = _record_fields(record, formatter)
+    category = getattr(record, "category", None)
+    payload = [
+        _HEADER.pack(record.created, record.levelno, category.value if category else 0)
+    ]
+    for key in ["name", "prefix", "message", "exc_text"]:
+        value = (fields.get(key) or "").encode("utf-8", "backslashreplace")
+        payload.append(_LENGTH.pack(len(value)))
+        payload.append(value)
+    payload = b"".join(payload)
+    return _LENGTH.pack(len(payload)) + payload
+
+
+def _decode_payload(payload: bytes) -> dict:
+    created, levelno, category = _HEADER.unpack_from(payload)
+    offset = _HEADER.size
+    strings = []
+    for _ in range(4):
+        (length,) = _LENGTH.unpack_from(payload, offset)
+        offset += _LENGTH.size
+        end = offset + length
+        strings.append(payload[offset:end].decode("utf-8"))
+        offset = end
+    name, prefix, message, exc_text = strings
+    fields = {
+        "created": created,
+        "levelname": logging.getLevelName(levelno),
+        "name": name,
+        "category": DataCategory(category).name if category else None,
+        "prefix": prefix,
+        "message": message,
+    }
+    if exc_text:
+        fields["exc_text"] = exc_text
+    return fields
+
+
+class BinaryFileHandler(logging.FileHandler):
+    """
+    File handler writing records with `encode_record`. Files start with
+    `MAGIC`, so `read_records` can tell them apart from JSON lines.
+
+    Unlike `logging.FileHandler`, this does not flush after each record:
+    writes are buffered until `flush` or `close` is called.
+    """
+
+    def __init__(self, filename: str, delay: bool = False):
+        super(BinaryFileHandler, self).__init__(filename, "ab", None, delay)
+
+    def _open(self):
+        stream = super(BinaryFileHandler, self)._open()
+        if stream.tell() == 0:
+            stream.write(MAGIC)
+        return stream
+
+    def emit(self, record):
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(
+                encode_record(record, self.formatter or _DEFAULT_FORMATTER)
+            )
+        except Exception:
+            self.handleError(record)
+
+
+def read_records(path: str) -> Iterator[dict]:
+    """
+    Stream the records written to `path` by a `BinaryFileHandler` or a
+    handler using `JsonFormatter`, as dictionaries with the keys described in
+    `JsonFormatter`.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            f.seek(0)
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+        while True:
+            length = f.read(_LENGTH.size)
+            if len(length) < _LENGTH.size:
+                return
+            (size,) = _LENGTH.unpack(length)
+            payload = f.read(size)
+            if len(payload) < size:
+                # Frame still being written.
+                return
+            yield _decode_payload(payload)
@@ -0,0 +1,34 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import asyncio
+import logging
+import pytest
+
+
+def _close_root_handlers() -> None:
+    for handler in list(logging.root.handlers):
+        logging.root.removeHandler(handler)
+        handler.close()
+
+
+@pytest.fixture
+def reset_root_handlers():
+    """
+    Function removing and closing the root handlers, as
+    `logging.basicConfig(force=True)` does from Python 3.8 on. Tests call it
+    before configuring logging, since pytest adds its own capture handlers to
+    the root logger while they run. It is also called after the test.
+    """
+    yield _close_root_handlers
+    _close_root_handlers()
+
+
+@pytest.fixture
+def loop():
+    """
+    New event loop, closed after the test (`asyncio.run` needs Python 3.7).
+    """
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
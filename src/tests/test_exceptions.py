@@ -2,16 +2,29 @@
 # Licensed under the MIT license.
 
 import io
+import json
 import pickle
 import pytest
 import re
+import sys
 from confidential_ml_utils.exceptions import (
     _PrefixStackTraceWrapper,
+    AllowList,
+    ExceptionHooks,
+    format_scrubbed_exception,
+    install_exception_hooks,
     prefix_stack_trace,
     SCRUB_MESSAGE,
     PREFIX,
     is_exception_allowed,
+    print_prefixed_stack_trace_and_raise,
     PrefixStackTrace,
+    print_worker_trace,
+    scrub_exception_traceback,
+    scrub_worker_exceptions,
+    ScrubbedWorkerError,
+    ScrubbingProcessPoolExecutor,
+    TraceDeduplicator,
 )
 from traceback import TracebackException
 
@@ -290,3 +303,683 @@ def test_prefix_stack_trace_respects_add_timestamp(add_timestamp):
     timestamp_match = re.search(timestamp_regex, file_value.split("\n")[0])
     assert bool(timestamp_match) == add_timestamp
     print("hello")
+
+
+@pytest.mark.parametrize(
+    "allow_list, expected_result",
+    [
+        (["argparse", "ModuleNotFound"], True),
+        (["argparse", "type"], False),
+        (["Bingo..+Pickle"], True),
+        ([], False),
+    ],
+)
+def test_allow_list_matches_like_a_plain_list(allow_list, expected_result):
+    exception = TracebackException.from_exception(
+        ModuleNotFoundError("Bingo. It is a pickle.")
+    )
+    compiled = AllowList(allow_list)
+    assert is_exception_allowed(exception, compiled) == expected_result
+    assert is_exception_allowed(exception, compiled) == expected_result
+    assert compiled.is_allowed.cache_info().hits == 1
+
+
+def test_allow_list_supports_patterns_which_cannot_be_joined():
+    allow_list = AllowList(["(?i)timeout", "KeyError", r"(?P<x>a)(?P=x)", r"(b)\1"])
+    assert allow_list.is_allowed(OSError, "Connection TIMEOUT")
+    assert allow_list.is_allowed(KeyError, "secret")
+    assert allow_list.is_allowed(ValueError, "aa")
+    assert allow_list.is_allowed(ValueError, "bb")
+    assert not allow_list.is_allowed(ValueError, "ab")
+
+    @prefix_stack_trace(io.StringIO(), allow_list=["(?i)timeout", "(?P<x>y)"])
+    def function():
+        raise OSError("timeout")
+
+    with pytest.raises(OSError, match="timeout"):
+        function()
+
+
+def test_allow_list_is_pickleable_and_bounded():
+    allow_list = AllowList(["value"], cache_size=2)
+    for i in range(5):
+        allow_list.is_allowed(KeyError, f"message {i}")
+    assert allow_list.is_allowed.cache_info().currsize == 2
+
+    unpickled = pickle.loads(pickle.dumps(allow_list))
+    assert unpickled.patterns == ["value"]
+    assert unpickled.is_allowed(ValueError, "secret")
+    assert not unpickled.is_allowed(KeyError, "secret")
+
+
+def test_prefix_stack_trace_accepts_allow_list_object():
+    file = io.StringIO()
+
+    @prefix_stack_trace(file, allow_list=AllowList(["ValueError"]))
+    def function():
+        raise ValueError("allowed message")
+
+    with pytest.raises(ValueError, match="allowed message"):
+        function()
+
+    assert "allowed message" in file.getvalue()
+
+
+def raise_chain(length: int):
+    try:
+        if length > 1:
+            raise_chain(length - 1)
+    finally:
+        raise ValueError(f"secret {length}")
+
+
+def test_scrub_exception_traceback_handles_long_chains():
+    try:
+        raise_chain(50)
+    except ValueError as e:
+        exception = TracebackException.from_exception(e)
+
+    scrub_exception_traceback(exception)
+
+    messages = []
+    node = exception
+    while node:
+        messages.append(node._str)
+        node = node.__cause__ or node.__context__
+    assert messages == [SCRUB_MESSAGE] * 50
+
+
+def long_exception_chain() -> tuple:
+    # Longer than the recursion limit, so it cannot be built recursively.
+    exception = None
+    for i in range(sys.getrecursionlimit() + 100):
+        try:
+            try:
+                if exception is not None:
+                    raise exception
+            finally:
+                raise ValueError(f"secret {i}")
+        except ValueError as e:
+            exception = e
+    return type(exception), exception, exception.__traceback__
+
+
+def test_exceptions_longer_than_recursion_limit_are_printed():
+    exc_info = long_exception_chain()
+    file = io.StringIO()
+    with pytest.raises(ValueError):
+        try:
+            raise exc_info[1]
+        except ValueError:
+            print_prefixed_stack_trace_and_raise(file, max_chain_depth=5)
+    assert file.getvalue().count(f"ValueError: {SCRUB_MESSAGE}") == 5
+    assert "ExceptionChainTruncated" in file.getvalue()
+
+    trace = format_scrubbed_exception(exc_info)
+    assert trace.count(f"ValueError: {SCRUB_MESSAGE}") == sys.getrecursionlimit() + 100
+
+
+def test_scrub_exception_traceback_scrubs_shared_nodes_once():
+    inner = TracebackException.from_exception(KeyError("secret"))
+    outer = TracebackException.from_exception(ValueError("secret"))
+    outer.__cause__ = outer.__context__ = inner
+    allow_list = AllowList(["nothing"])
+
+    scrub_exception_traceback(outer, allow_list=allow_list)
+
+    assert inner._str == outer._str == SCRUB_MESSAGE
+    assert allow_list.is_allowed.cache_info().misses == 2
+
+
+def test_print_prefixed_stack_trace_truncates_long_chains():
+    file = io.StringIO()
+
+    with pytest.raises(ValueError):
+        try:
+            raise_chain(10)
+        except ValueError:
+            print_prefixed_stack_trace_and_raise(file, max_chain_depth=3)
+
+    log_lines = file.getvalue()
+    assert log_lines.count("ValueError: ") == 3
+    assert "ExceptionChainTruncated: Exception chain truncated after 3" in log_lines
+
+
+def test_print_prefixed_stack_trace_writes_once_with_single_timestamp():
+    class CountingIO(io.StringIO):
+        writes = 0
+
+        def write(self, s):
+            self.writes += 1
+            return super().write(s)
+
+    file = CountingIO()
+    with pytest.raises(ValueError):
+        with PrefixStackTrace(file=file, add_timestamp=True):
+            raise_chain(3)
+
+    lines = file.getvalue().splitlines()
+    assert file.writes == 1
+    assert len({line[: len(PREFIX) + 20] for line in lines}) == 1
+
+
+def test_concurrent_traces_are_not_interleaved():
+    import threading
+
+    file = io.StringIO()
+
+    @prefix_stack_trace(file)
+    def function(i):
+        raise_chain(5)
+
+    def run(i):
+        with pytest.raises(ValueError):
+            function(i)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # All threads print the same trace, so the output must be made of
+    # identical contiguous blocks.
+    output = file.getvalue()
+    trace = output[: len(output) // 8]
+    assert trace.count(f"ValueError: {SCRUB_MESSAGE}") == 5
+    assert output == trace * 8
+
+
+def test_file_locks_do_not_outlive_files():
+    import gc
+    from confidential_ml_utils import exceptions
+
+    class SlotsFile:
+        __slots__ = ["lines"]
+
+        def __init__(self):
+            self.lines = []
+
+        def write(self, text):
+            self.lines.append(text)
+
+    gc.collect()
+    locks = len(exceptions._FILE_LOCKS)
+    file = io.StringIO()
+    with pytest.raises(ValueError):
+        prefix_stack_trace(file)(raise_chain)(1)
+    assert len(exceptions._FILE_LOCKS) == locks + 1
+    del file
+    gc.collect()
+    assert len(exceptions._FILE_LOCKS) == locks
+
+    # Files which cannot be weakly referenced share a lock.
+    file = SlotsFile()
+    with pytest.raises(ValueError):
+        prefix_stack_trace(file)(raise_chain)(1)
+    assert f"ValueError: {SCRUB_MESSAGE}" in "".join(file.lines)
+
+
+def test_prefix_stack_trace_routes_through_logger():
+    import logging
+
+    stream = io.StringIO()
+    logger = logging.getLogger("trace_logger")
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter("%(prefix)s[%(category)s]%(message)s"))
+    logger.addHandler(handler)
+    file = io.StringIO()
+
+    message = "private data"
+
+    @prefix_stack_trace(file, logger=logger)
+    def function():
+        raise ValueError(message)
+
+    try:
+        with pytest.raises(ValueError):
+            function()
+    finally:
+        logger.removeHandler(handler)
+
+    assert file.getvalue() == ""
+    output = stream.getvalue()
+    assert output.startswith(f"[DataCategory.PUBLIC]{PREFIX} Traceback")
+    assert output.rstrip().endswith(f"{PREFIX} ValueError: {SCRUB_MESSAGE}")
+    assert message not in output
+
+
+def ping(n):
+    if n == 0:
+        raise RecursionError("too deep")
+    pong(n - 1)
+
+
+def pong(n):
+    ping(n)
+
+
+def test_prefix_stack_trace_hides_its_own_frames():
+    file = io.StringIO()
+
+    @prefix_stack_trace(file)
+    def function():
+        raise ValueError()
+
+    with pytest.raises(ValueError):
+        function()
+
+    assert "in wrapper" not in file.getvalue()
+    assert "in function" in file.getvalue()
+
+
+def test_prefix_stack_trace_folds_repeated_frames():
+    file = io.StringIO()
+
+    with pytest.raises(RecursionError):
+        with PrefixStackTrace(file=file, fold_repeated_frames=True):
+            ping(100)
+
+    log_lines = file.getvalue()
+    assert log_lines.count("in ping") == 2
+    assert "[Previous 2 frame(s) repeated 99 more times]" in log_lines
+
+
+@pytest.mark.parametrize("max_frames,has_tail", [(5, True), (1, False)])
+def test_prefix_stack_trace_respects_max_frames(max_frames, has_tail):
+    file = io.StringIO()
+
+    with pytest.raises(RecursionError):
+        with PrefixStackTrace(file=file, max_frames=max_frames):
+            ping(10)
+
+    lines = [line for line in file.getvalue().splitlines() if "File " in line]
+    assert len(lines) == max_frames
+    assert f"[{22 - max_frames} frames omitted]" in file.getvalue()
+    assert "test_prefix_stack_trace_respects_max_frames" in lines[0]
+    assert ("in ping" in lines[-1]) == has_tail
+
+
+def test_prefix_stack_trace_only_reads_lines_of_kept_frames(monkeypatch):
+    import linecache
+
+    file = io.StringIO()
+    getline = linecache.getline
+    calls = []
+    monkeypatch.setattr(
+        linecache, "getline", lambda *args: calls.append(args) or getline(*args)
+    )
+
+    with pytest.raises(RecursionError):
+        with PrefixStackTrace(file=file, max_frames=4):
+            ping(100)
+
+    assert 0 < len(calls) <= 4
+    assert "ping(n)" in file.getvalue()
+
+
+def test_prefix_stack_trace_skips_source_lines():
+    file = io.StringIO()
+
+    with pytest.raises(RecursionError):
+        with PrefixStackTrace(file=file, lookup_lines=False):
+            ping(2)
+
+    log_lines = file.getvalue()
+    assert "in pong" in log_lines
+    assert "ping(n)" not in log_lines
+
+
+def test_prefix_stack_trace_dedup_prints_full_trace_once():
+    file = io.StringIO()
+    dedup = TraceDeduplicator(summary_interval=0)
+
+    @prefix_stack_trace(file, dedup=dedup)
+    def function(row):
+        raise ValueError(f"bad row {row}")
+
+    for row in range(3):
+        with pytest.raises(ValueError):
+            function(row)
+
+    log_lines = file.getvalue()
+    assert log_lines.count("Traceback") == 1
+    fingerprints = re.findall(r"fingerprint (\w+) seen (\d) times", log_lines)
+    assert len({f for f, _ in fingerprints}) == 1
+    assert [n for _, n in fingerprints] == ["1", "2", "3"]
+    assert f"ValueError: {SCRUB_MESSAGE}" in log_lines
+
+
+def test_trace_deduplicator_is_bounded_and_summarizes():
+    dedup = TraceDeduplicator(cache_size=2, summary_interval=1e-9)
+    for fingerprint in ["a", "b", "a", "c"]:
+        count, summary = dedup.observe(fingerprint)
+
+    assert count == 1
+    assert summary == [
+        "Exception fingerprint summary: a seen 2 times",
+        "Exception fingerprint summary: c seen 1 times",
+    ]
+    assert dedup.observe("b")[0] == 1
+
+    unpickled = pickle.loads(pickle.dumps(dedup))
+    assert unpickled.observe("b")[0] == 2
+
+
+def test_prefix_stack_trace_supports_coroutines(loop):
+    import asyncio
+
+    file = io.StringIO()
+
+    @prefix_stack_trace(file)
+    async def function():
+        await asyncio.sleep(0)
+        raise ValueError("private")
+
+    with pytest.raises(ValueError, match=re.escape(SCRUB_MESSAGE)):
+        loop.run_until_complete(function())
+
+    assert f"ValueError: {SCRUB_MESSAGE}" in file.getvalue()
+
+
+def test_prefix_stack_trace_supports_generators():
+    file = io.StringIO()
+
+    @prefix_stack_trace(file)
+    def function():
+        received = yield 1
+        yield received
+        raise ValueError("private")
+
+    generator = function()
+    assert next(generator) == 1
+    assert generator.send("sent") == "sent"
+    with pytest.raises(ValueError, match=re.escape(SCRUB_MESSAGE)):
+        next(generator)
+    assert f"ValueError: {SCRUB_MESSAGE}" in file.getvalue()
+
+    file.truncate(0)
+    generator = function()
+    next(generator)
+    generator.close()
+    assert file.getvalue() == ""
+
+
+def test_prefix_stack_trace_supports_async_generators(loop):
+    file = io.StringIO()
+
+    @prefix_stack_trace(file)
+    async def function():
+        received = yield 1
+        yield received
+        raise ValueError("private")
+
+    async def main():
+        generator = function()
+        assert await generator.__anext__() == 1
+        assert await generator.asend("sent") == "sent"
+        with pytest.raises(ValueError, match=re.escape(SCRUB_MESSAGE)):
+            await generator.__anext__()
+
+        generator = function()
+        assert [item async for item in generator][:1] == [1]
+
+    with pytest.raises(ValueError):
+        loop.run_until_complete(main())
+    assert file.getvalue().count(f"ValueError: {SCRUB_MESSAGE}") == 2
+
+
+def test_prefix_stack_trace_async_context_manager(loop):
+    import asyncio
+
+    file = io.StringIO()
+
+    async def main():
+        async with PrefixStackTrace(file=file):
+            await asyncio.sleep(0)
+            raise ValueError("private")
+
+    with pytest.raises(ValueError, match=re.escape(SCRUB_MESSAGE)):
+        loop.run_until_complete(main())
+    assert f"ValueError: {SCRUB_MESSAGE}" in file.getvalue()
+
+
+def test_prefix_stack_trace_ignores_cancellation(loop):
+    import asyncio
+
+    file = io.StringIO()
+
+    @prefix_stack_trace(file)
+    async def function():
+        await asyncio.sleep(10)
+
+    async def main():
+        task = asyncio.ensure_future(function())
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    loop.run_until_complete(main())
+    assert file.getvalue() == ""
+
+
+def fail_in_worker(value):
+    try:
+        raise KeyError(value)
+    except KeyError as e:
+        raise ValueError(f"private {value}") from e
+
+
+def square(value):
+    return value * value
+
+
+def test_scrub_worker_exceptions_ships_scrubbed_trace():
+    secret = "".join(["hun", "ter2"])
+    function = pickle.loads(pickle.dumps(scrub_worker_exceptions(fail_in_worker)))
+
+    with pytest.raises(ScrubbedWorkerError) as info:
+        function(secret)
+
+    err = pickle.loads(pickle.dumps(info.value))
+    assert err.__cause__ is None and err.__context__ is None
+    assert str(err) == f"{PREFIX} ValueError: {SCRUB_MESSAGE}"
+    assert [e["type"] for e in err.trace["exceptions"]] == ["KeyError", "ValueError"]
+    assert [e["chained_from"] for e in err.trace["exceptions"]] == [None, "cause"]
+    assert secret not in repr(err.trace)
+
+    file = io.StringIO()
+    print_worker_trace(err, prefix_stack_trace(file))
+    lines = file.getvalue().splitlines()
+    assert all(line.startswith(PREFIX) for line in lines)
+    assert "The above exception was the direct cause" in file.getvalue()
+    assert f"ValueError: {SCRUB_MESSAGE}" in lines[-1]
+
+
+def test_scrub_worker_exceptions_respects_allow_list():
+    stack_trace = prefix_stack_trace(allow_list=["ValueError"])
+    function = scrub_worker_exceptions(fail_in_worker, stack_trace)
+
+    with pytest.raises(ScrubbedWorkerError, match="ValueError: private 3"):
+        function(3)
+
+
+def test_scrubbing_process_pool_executor():
+    file = io.StringIO()
+    secret = "".join(["hun", "ter2"])
+
+    with ScrubbingProcessPoolExecutor(
+        max_workers=2, stack_trace=prefix_stack_trace(file)
+    ) as executor:
+        assert list(executor.map(square, [1, 2, 3])) == [1, 4, 9]
+        future = executor.submit(fail_in_worker, secret)
+        with pytest.raises(ScrubbedWorkerError):
+            future.result()
+
+    assert secret not in file.getvalue()
+    assert f"{PREFIX} ValueError: {SCRUB_MESSAGE}" in file.getvalue()
+    assert "fail_in_worker" in file.getvalue()
+
+
+def parse_report(line: str) -> dict:
+    assert line.startswith(f"{PREFIX} {{")
+    return json.loads(line[line.index("{") :])  # noqa: E203
+
+
+def test_prefix_stack_trace_json_output():
+    file = io.StringIO()
+    secret = "".join(["hun", "ter2"])
+
+    @prefix_stack_trace(file, allow_list=["KeyError"], output_format="json")
+    def function():
+        fail_in_worker(secret)
+
+    with pytest.raises(ValueError):
+        function()
+
+    lines = file.getvalue().splitlines()
+    assert len(lines) == 1
+    report = parse_report(lines[0])
+    assert report["prefix"] == PREFIX
+    assert "timestamp" in report
+    exceptions = report["exceptions"]
+    assert [e["type"] for e in exceptions] == ["KeyError", "ValueError"]
+    assert [e["chained_from"] for e in exceptions] == [None, "cause"]
+    assert exceptions[0]["message"] == repr(secret)
+    assert exceptions[1]["message"] == SCRUB_MESSAGE
+    assert exceptions[1]["frames"][-1]["name"] == "fail_in_worker"
+    assert "function" in [f["name"] for f in exceptions[1]["frames"]]
+
+
+def test_prefix_stack_trace_context_manager_json_output_with_dedup():
+    file = io.StringIO()
+    dedup = TraceDeduplicator(summary_interval=0)
+
+    for _ in range(2):
+        with pytest.raises(KeyError):
+            with PrefixStackTrace(file=file, dedup=dedup, output_format="json"):
+                raise KeyError("private")
+
+    first, second = [parse_report(line) for line in file.getvalue().splitlines()]
+    assert first["count"] == 1 and first["exceptions"][0]["type"] == "KeyError"
+    assert second["count"] == 2 and "exceptions" not in second
+    assert first["fingerprint"] == second["fingerprint"]
+
+
+def test_prefix_stack_trace_rejects_unknown_output_format():
+    with pytest.raises(ValueError):
+        prefix_stack_trace(output_format="xml")
+    with pytest.raises(ValueError):
+        PrefixStackTrace(output_format="xml")
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 8), reason="threading.excepthook is new in Python 3.8"
+)
+def test_exception_hooks_replace_and_restore_hooks():
+    import sys
+    import threading
+
+    previous = sys.excepthook, threading.excepthook
+    hooks = install_exception_hooks(prefix_stack_trace(io.StringIO()))
+    assert sys.excepthook == hooks.excepthook
+    assert threading.excepthook == hooks.threading_excepthook
+    hooks.uninstall()
+    assert (sys.excepthook, threading.excepthook) == previous
+
+
+def test_exception_hooks_excepthook_scrubs():
+    import sys
+
+    file = io.StringIO()
+    hooks = ExceptionHooks(prefix_stack_trace(file))
+    try:
+        fail_in_worker("private")
+    except ValueError:
+        hooks.excepthook(*sys.exc_info())
+
+    lines = file.getvalue().splitlines()
+    assert all(line.startswith(PREFIX) for line in lines)
+    assert f"ValueError: {SCRUB_MESSAGE}" in lines[-1]
+    assert "private" not in lines[-1]
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 8), reason="threading.excepthook is new in Python 3.8"
+)
+def test_exception_hooks_threads():
+    import threading
+
+    file = io.StringIO()
+    hooks = install_exception_hooks(prefix_stack_trace(file))
+    try:
+        thread = threading.Thread(target=fail_in_worker, args=("private",))
+        thread.start()
+        thread.join()
+    finally:
+        hooks.uninstall()
+    assert f"{PREFIX} ValueError: {SCRUB_MESSAGE}" in file.getvalue()
+
+
+def test_exception_hooks_asyncio_loop(loop):
+    file = io.StringIO()
+    hooks = ExceptionHooks(prefix_stack_trace(file))
+
+    async def main():
+        hooks.install_loop(loop)
+        try:
+            fail_in_worker("private")
+        except ValueError as e:
+            loop.call_exception_handler(
+                {"message": "Task exception was never retrieved", "exception": e}
+            )
+
+    loop.run_until_complete(main())
+    lines = file.getvalue().splitlines()
+    assert lines[0] == f"{PREFIX} Task exception was never retrieved"
+    assert lines[-1] == f"{PREFIX} ValueError: {SCRUB_MESSAGE}"
+
+
+def test_exception_hooks_uncaught_exception_in_process():
+    import os
+    import subprocess
+    import sys
+
+    code = (
+        "from confidential_ml_utils.exceptions import install_exception_hooks\n"
+        "install_exception_hooks()\n"
+        "raise ValueError('hun' + 'ter2')\n"
+    )
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(__file__)), env.get("PYTHONPATH", "")]
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], stderr=subprocess.PIPE, env=env
+    )
+    stderr = result.stderr.decode()
+    assert result.returncode == 1
+    assert "hunter2" not in stderr
+    assert stderr.splitlines()[-1] == f"{PREFIX} ValueError: {SCRUB_MESSAGE}"
+
+
+def test_format_scrubbed_exception_caches_frames():
+    import sys
+    from confidential_ml_utils.exceptions import _format_frame
+
+    texts = []
+    for _ in range(2):
+        try:
+            fail_in_worker("private")
+        except ValueError:
+            exc_info = sys.exc_info()
+            texts.append(format_scrubbed_exception(exc_info, allow_list=["KeyError"]))
+    hits = _format_frame.cache_info().hits
+
+    assert texts[0] == texts[1]
+    assert "KeyError: 'private'" in texts[0]
+    assert texts[0].endswith(f"ValueError: {SCRUB_MESSAGE}")
+    assert 'raise ValueError(f"private {value}") from e' in texts[0]
+    format_scrubbed_exception(exc_info)
+    assert _format_frame.cache_info().hits > hits
@@ -0,0 +1,246 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import confidential_ml_utils
+from confidential_ml_utils.constants import DataCategory
+from confidential_ml_utils.handlers import (
+    BufferedRotatingFileHandler,
+    buffered_category_handler,
+    RankForwardingHandler,
+    RankLogCollector,
+)
+import gzip
+import io
+import logging
+import pytest
+import threading
+import time
+
+
+def make_record(msg: str, level: int = logging.INFO):
+    return logging.makeLogRecord(
+        {"msg": msg, "levelno": level, "levelname": logging.getLevelName(level)}
+    )
+
+
+def test_buffered_handler_batches_until_flush(tmp_path):
+    path = tmp_path / "out.log"
+    handler = BufferedRotatingFileHandler(str(path), flush_interval=0)
+    try:
+        handler.handle(make_record("first"))
+        handler.handle(make_record("second"))
+        assert not path.exists()
+
+        handler.flush()
+        assert path.read_text() == "first\nsecond\n"
+    finally:
+        handler.close()
+
+
+@pytest.mark.parametrize(
+    "kwargs,level",
+    [({"buffer_size": 1}, logging.INFO), ({}, logging.ERROR)],
+)
+def test_buffered_handler_flushes_on_thresholds(tmp_path, kwargs, level):
+    path = tmp_path / "out.log"
+    handler = BufferedRotatingFileHandler(str(path), flush_interval=0, **kwargs)
+    try:
+        handler.handle(make_record("message", level))
+        assert path.read_text() == "message\n"
+    finally:
+        handler.close()
+
+
+@pytest.mark.parametrize("compress", [True, False])
+def test_buffered_handler_rotates_and_prunes(tmp_path, compress):
+    path = tmp_path / "out.log"
+    handler = BufferedRotatingFileHandler(
+        str(path),
+        max_bytes=10,
+        backup_count=2,
+        buffer_size=1,
+        flush_interval=0,
+        compress=compress,
+    )
+    for i in range(5):
+        handler.handle(make_record(f"line {i}"))
+    handler.close()
+
+    segments = handler.segments()
+    assert [n for n, _ in segments] == [3, 4]
+    assert path.read_text() == "line 4\n"
+    last = segments[-1][1]
+    assert last.endswith(".gz") == compress
+    opener = gzip.open if compress else open
+    with opener(last, "rt") as f:
+        assert f.read() == "line 3\n"
+
+
+def test_buffered_handler_never_rotates_without_max_bytes(tmp_path):
+    path = tmp_path / "out.log"
+    handler = BufferedRotatingFileHandler(str(path), max_bytes=0, flush_interval=0)
+    for i in range(3):
+        handler.handle(make_record(f"line {i}"))
+        handler.flush()
+    handler.close()
+
+    assert handler.segments() == []
+    assert path.read_text() == "line 0\nline 1\nline 2\n"
+
+
+def test_buffered_handler_can_be_closed_again_at_shutdown(tmp_path):
+    handler = BufferedRotatingFileHandler(str(tmp_path / "out.log"))
+    other = logging.StreamHandler(io.StringIO())
+    handler.close()
+    # `logging.shutdown` closes handlers again, e.g. at exit.
+    logging.shutdown([lambda: other, lambda: handler])
+
+
+def test_buffered_category_handler_splits_files(tmp_path, reset_root_handlers):
+    public, private = tmp_path / "public.log", tmp_path / "private.log"
+    reset_root_handlers()
+    confidential_ml_utils.enable_confidential_logging(
+        handlers=[buffered_category_handler(str(public), str(private))],
+        format="%(prefix)s%(message)s",
+    )
+    log = logging.getLogger("buffered")
+    log.setLevel("INFO")
+    log.info("public", category=DataCategory.PUBLIC)
+    log.info("PRIVATE")
+
+    reset_root_handlers()
+
+    assert public.read_text() == "SystemLog:public\n"
+    assert private.read_text() == "PRIVATE\n"
+
+
+def test_rank_log_collector_dedups_and_tags_ranks():
+    stream = io.StringIO()
+    target = logging.StreamHandler(stream)
+    target.setFormatter(logging.Formatter("%(rank)s:%(prefix)s%(message)s"))
+    collector = RankLogCollector(handlers=[target])
+    collector.start()
+
+    def rank_main(rank):
+        handler = RankForwardingHandler(collector.address, rank=rank)
+        for msg, category in [
+            ("shared", DataCategory.PRIVATE),
+            (f"rank {rank}", DataCategory.PRIVATE),
+            ("public", DataCategory.PUBLIC),
+        ]:
+            handler.handle(
+                logging.makeLogRecord(
+                    {
+                        "msg": msg,
+                        "levelno": logging.INFO,
+                        "category": category,
+                        "prefix": "SystemLog:" if msg == "public" else "",
+                    }
+                )
+            )
+        handler.close()
+
+    threads = [threading.Thread(target=rank_main, args=(r,)) for r in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    collector.close()
+
+    lines = stream.getvalue().splitlines()
+    assert sorted(line.split(":", 1)[1] for line in lines) == [
+        "SystemLog:public",
+        "rank 0",
+        "rank 1",
+        "rank 2",
+        "shared",
+    ]
+    assert "0:SystemLog:public" in lines
+    assert "1:rank 1" in lines
+
+
+def test_rank_log_collector_keeps_lines_repeated_by_one_rank():
+    stream = io.StringIO()
+    target = logging.StreamHandler(stream)
+    target.setFormatter(logging.Formatter("%(rank)s:%(message)s"))
+    collector = RankLogCollector(handlers=[target])
+    collector.start()
+
+    handler = RankForwardingHandler(collector.address, rank=1)
+    for _ in range(2):
+        handler.handle(
+            logging.makeLogRecord({"msg": "checkpoint saved", "levelno": logging.INFO})
+        )
+    handler.close()
+    collector.close()
+
+    assert stream.getvalue().splitlines() == ["1:checkpoint saved"] * 2
+
+
+def test_rank_forwarding_handler_bounds_records_and_backs_off(tmp_path):
+    handler = RankForwardingHandler(
+        str(tmp_path / "missing.sock"),
+        rank=0,
+        batch_size=1,
+        flush_interval=0,
+        max_pending=10,
+        retry_interval=60.0,
+    )
+    errors = []
+    handler.handleError = errors.append
+    for i in range(1000):
+        handler.handle(logging.makeLogRecord({"msg": f"step {i}"}))
+
+    assert len(handler._batch) == 10
+    assert handler._batch[0]["msg"] == "step 990"
+    assert handler.dropped == 990
+    # Only the first record tried to connect.
+    assert len(errors) == 1
+    handler._batch.clear()
+    handler.close()
+
+
+def test_rank_forwarding_handler_flushes_idle_batches():
+    stream = io.StringIO()
+    collector = RankLogCollector(handlers=[logging.StreamHandler(stream)])
+    collector.start()
+
+    handler = RankForwardingHandler(collector.address, rank=0, flush_interval=0.05)
+    handler.handle(logging.makeLogRecord({"msg": "idle", "levelno": logging.INFO}))
+    deadline = time.monotonic() + 5
+    while not stream.getvalue() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # Shipped before the handler is closed.
+    logs = stream.getvalue()
+    handler.close()
+    collector.close()
+
+    assert logs == "idle\n"
+
+
+def test_rank_log_collector_dedups_within_window():
+    stream = io.StringIO()
+    collector = RankLogCollector(
+        handlers=[logging.StreamHandler(stream)], dedup_window=0.05
+    )
+    try:
+
+        def emit(rank):
+            collector._emit(
+                {
+                    "name": "train",
+                    "levelno": logging.INFO,
+                    "category": DataCategory.PRIVATE,
+                    "msg": "epoch done",
+                    "rank": rank,
+                }
+            )
+
+        emit(0)
+        emit(1)
+        time.sleep(0.1)
+        emit(2)
+    finally:
+        collector._listener.close()
+
+    assert stream.getvalue().splitlines() == ["epoch done"] * 2
@@ -7,6 +7,7 @@ import io
 import logging
 import pytest
 import re
+import sys
 
 
 def test_basic_config():
@@ -90,3 +91,513 @@ def test_all_the_stuff():
     log.info("PRIVATE", category=DataCategory.PRIVATE)
 
     log.info("PRIVATE2")
+
+
+def test_queue_mode_writes_through_background_listener(reset_root_handlers):
+    stream = io.StringIO()
+    reset_root_handlers()
+    confidential_ml_utils.enable_confidential_logging(
+        use_queue=True,
+        stream=stream,
+        format="%(prefix)s%(levelname)s:%(name)s:%(message)s",
+    )
+    log = logging.getLogger("queued")
+    log.setLevel("INFO")
+    log.info("public", category=DataCategory.PUBLIC)
+    log.info("PRIVATE")
+
+    confidential_ml_utils.logging._stop_queue_listener()
+    logs = stream.getvalue()
+
+    assert re.search(r"^SystemLog\:INFO\:queued\:public$", logs, flags=re.M)
+    assert re.search(r"^INFO\:queued\:PRIVATE$", logs, flags=re.M)
+    assert logging.getLogger().handlers[0].stream is stream
+
+
+@pytest.mark.parametrize(
+    "overflow,expected",
+    [
+        ("drop-oldest", ["private 2", "public 2", "new"]),
+        ("drop-private-first", ["public 1", "public 2", "new"]),
+    ],
+)
+def test_record_queue_eviction(overflow, expected):
+    record_queue = confidential_ml_utils.logging._RecordQueue(3)
+    handler = confidential_ml_utils.logging._ConfidentialQueueHandler(
+        record_queue, overflow
+    )
+    for msg, category in [
+        ("public 1", DataCategory.PUBLIC),
+        ("private 1", DataCategory.PRIVATE),
+        ("private 2", DataCategory.PRIVATE),
+        ("public 2", DataCategory.PUBLIC),
+        ("new", DataCategory.PRIVATE),
+    ]:
+        record = logging.makeLogRecord({"msg": msg, "category": category})
+        handler.emit(record)
+    assert [r.msg for r in record_queue.queue] == expected
+
+
+def test_record_queue_dequeues_in_order_across_categories():
+    record_queue = confidential_ml_utils.logging._RecordQueue(3)
+    for i, category in enumerate([DataCategory.PUBLIC, DataCategory.PRIVATE] * 3):
+        record = logging.makeLogRecord({"msg": i, "category": category})
+        record_queue.put_evicting(record, private_first=True)
+    # Private records 1 and 3 are evicted first, then the oldest record.
+    assert [record_queue.get_nowait().msg for _ in range(3)] == [2, 4, 5]
+
+
+def test_unknown_overflow_policy_raises():
+    with pytest.raises(ValueError):
+        confidential_ml_utils.enable_confidential_logging(overflow="nope")
+
+
+def test_public_only_drops_private_calls_before_formatting():
+    class Unformattable:
+        def __str__(self):
+            raise AssertionError("private arguments should not be formatted")
+
+    confidential_ml_utils.enable_confidential_logging(public_only=True)
+    log = logging.getLogger("public_only")
+    log.setLevel("INFO")
+
+    with StreamHandlerContext(
+        log, "%(prefix)s%(levelname)s:%(name)s:%(message)s"
+    ) as context:
+        log.info("private %s", DataCategory.PRIVATE, Unformattable())
+        log.warning("PRIVATE")
+        log.info("public", category=DataCategory.PUBLIC)
+        logs = str(context)
+
+    assert logs == "SystemLog:INFO:public_only:public\n"
+    assert confidential_ml_utils.logging.get_dropped_private_count() == 2
+
+    confidential_ml_utils.enable_confidential_logging()
+    assert confidential_ml_utils.logging.get_dropped_private_count() == 0
+
+
+def test_public_only_counts_dropped_calls_of_all_threads():
+    import threading
+
+    confidential_ml_utils.enable_confidential_logging(public_only=True)
+    log = logging.getLogger("public_only")
+    log.setLevel("INFO")
+    get_count = confidential_ml_utils.logging.get_dropped_private_count
+
+    def drop():
+        for _ in range(1000):
+            log.info("PRIVATE")
+            get_count()
+
+    threads = [threading.Thread(target=drop) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert get_count() == get_count() == 4000
+    confidential_ml_utils.enable_confidential_logging()
+
+
+def test_category_routing_handler_routes_by_category():
+    confidential_ml_utils.enable_confidential_logging()
+    public, private = io.StringIO(), io.StringIO()
+    handler = confidential_ml_utils.logging.CategoryRoutingHandler(
+        {
+            DataCategory.PUBLIC: logging.StreamHandler(public),
+            DataCategory.PRIVATE: logging.StreamHandler(private),
+        }
+    )
+    log = logging.getLogger("routing")
+    log.setLevel("INFO")
+    log.addHandler(handler)
+    try:
+        log.info("public", category=DataCategory.PUBLIC)
+        log.info("PRIVATE")
+    finally:
+        log.removeHandler(handler)
+
+    assert public.getvalue() == "public\n"
+    assert private.getvalue() == "PRIVATE\n"
+
+
+def test_category_routing_handler_drops_unrouted_categories():
+    confidential_ml_utils.enable_confidential_logging()
+    public = io.StringIO()
+    handler = confidential_ml_utils.logging.CategoryRoutingHandler(
+        {DataCategory.PUBLIC: logging.StreamHandler(public)}
+    )
+    record = logging.makeLogRecord({"msg": "no category"})
+    handler.handle(record)
+    assert public.getvalue() == ""
+
+
+def test_prefix_scope_overrides_global_prefix():
+    confidential_ml_utils.enable_confidential_logging()
+    PrefixScope = confidential_ml_utils.logging.PrefixScope
+    get_prefix = confidential_ml_utils.logging.get_prefix
+
+    with PrefixScope("outer:"):
+        assert get_prefix() == "outer:"
+        with PrefixScope("inner:"):
+            assert get_prefix() == "inner:"
+        assert get_prefix() == "outer:"
+    assert get_prefix() == "SystemLog:"
+
+    @PrefixScope("decorated:")
+    def function():
+        return get_prefix()
+
+    assert function() == "decorated:"
+    assert get_prefix() == "SystemLog:"
+
+
+def test_prefix_scope_is_isolated_between_threads():
+    import threading
+
+    confidential_ml_utils.enable_confidential_logging()
+    PrefixScope = confidential_ml_utils.logging.PrefixScope
+    get_prefix = confidential_ml_utils.logging.get_prefix
+    results = {}
+    barrier = threading.Barrier(2)
+
+    def job(name):
+        with PrefixScope(f"{name}:"):
+            barrier.wait()
+            results[name] = get_prefix()
+
+    threads = [threading.Thread(target=job, args=(n,)) for n in ["a", "b"]]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == {"a": "a:", "b": "b:"}
+    assert get_prefix() == "SystemLog:"
+
+
+@pytest.mark.skipif(
+    sys.version_info < (3, 7), reason="contextvars is new in Python 3.7"
+)
+def test_prefix_scope_is_isolated_between_tasks(loop):
+    import asyncio
+
+    confidential_ml_utils.enable_confidential_logging()
+    PrefixScope = confidential_ml_utils.logging.PrefixScope
+    get_prefix = confidential_ml_utils.logging.get_prefix
+
+    async def task(name):
+        @PrefixScope(f"{name}:")
+        async def scoped():
+            await asyncio.sleep(0)
+            return get_prefix()
+
+        return await scoped()
+
+    async def main():
+        return await asyncio.gather(task("c"), task("d"))
+
+    assert loop.run_until_complete(main()) == ["c:", "d:"]
+    assert get_prefix() == "SystemLog:"
+
+
+def test_prefix_scope_can_be_shared_between_threads():
+    import threading
+
+    confidential_ml_utils.enable_confidential_logging()
+    scope = confidential_ml_utils.logging.PrefixScope("shared:")
+    get_prefix = confidential_ml_utils.logging.get_prefix
+    entered = threading.Event()
+    exited = threading.Event()
+    results = {}
+
+    def first():
+        with scope:
+            entered.set()
+            exited.wait()
+        results["first"] = get_prefix()
+
+    def second():
+        entered.wait()
+        with scope:
+            exited.set()
+            threads[0].join()
+        results["second"] = get_prefix()
+
+    threads = [threading.Thread(target=f) for f in [first, second]]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == {"first": "SystemLog:", "second": "SystemLog:"}
+
+
+def test_prefix_scope_applies_to_public_log_lines():
+    confidential_ml_utils.enable_confidential_logging()
+    log = logging.getLogger("scoped")
+    log.setLevel("INFO")
+
+    with StreamHandlerContext(log, "%(prefix)s%(message)s") as context:
+        with confidential_ml_utils.logging.PrefixScope("Job:"):
+            log.info("public", category=DataCategory.PUBLIC)
+            log.info("PRIVATE")
+        logs = str(context)
+
+    assert logs == "Job:public\nPRIVATE\n"
+
+
+def test_disabled_methods_are_noops_until_level_changes():
+    confidential_ml_utils.enable_confidential_logging()
+    log = logging.getLogger("fast_path")
+    log.setLevel("INFO")
+
+    with StreamHandlerContext(log, "%(message)s") as context:
+        log.debug("first")
+        assert log.debug is confidential_ml_utils.logging._noop
+        log.debug("second")
+
+        logging.getLogger().setLevel("WARNING")
+        log.setLevel("DEBUG")
+        context.handler.setLevel("DEBUG")
+        assert "debug" not in vars(log)
+        log.debug("third")
+
+        logging.disable(logging.INFO)
+        try:
+            log.info("fourth")
+            assert log.info is confidential_ml_utils.logging._noop
+        finally:
+            logging.disable(logging.NOTSET)
+        log.info("fifth")
+        logs = str(context)
+
+    assert logs == "third\nfifth\n"
+
+
+def test_disabled_logger_keeps_regular_methods():
+    confidential_ml_utils.enable_confidential_logging()
+    log = logging.getLogger("disabled")
+    log.setLevel("INFO")
+    log.disabled = True
+    log.info("dropped")
+    assert "info" not in vars(log)
+    log.disabled = False
+
+    with StreamHandlerContext(log, "%(message)s") as context:
+        log.info("kept")
+        logs = str(context)
+
+    assert logs == "kept\n"
+
+
+def test_directly_created_logger_methods_are_enabled_by_set_level():
+    confidential_ml_utils.enable_confidential_logging()
+    log = confidential_ml_utils.logging.ConfidentialLogger("direct")
+    log.setLevel("INFO")
+
+    with StreamHandlerContext(log, "%(message)s") as context:
+        log.debug("first")
+        log.setLevel("DEBUG")
+        context.handler.setLevel("DEBUG")
+        log.debug("second")
+        logs = str(context)
+
+    assert logs == "second\n"
+
+
+def test_stdlib_manager_keeps_regular_methods():
+    confidential_ml_utils.enable_confidential_logging()
+    manager = logging.Logger.manager
+    logging.Logger.manager = logging.Manager(logging.root)
+    try:
+        log = confidential_ml_utils.logging.ConfidentialLogger("stdlib_manager")
+        log.setLevel("INFO")
+        log.debug("first")
+        assert "debug" not in vars(log)
+    finally:
+        logging.Logger.manager = manager
+
+
+def test_rate_limit_filter_limits_per_call_site_and_category(reset_root_handlers):
+    rate_limit = confidential_ml_utils.logging.RateLimitFilter(
+        public_limit=2, private_limit=None, interval=60.0
+    )
+    stream = io.StringIO()
+    reset_root_handlers()
+    confidential_ml_utils.enable_confidential_logging(
+        stream=stream, format="%(message)s", rate_limit=rate_limit
+    )
+    log = logging.getLogger("rate_limited")
+    log.setLevel("INFO")
+
+    for i in range(5):
+        log.info(f"public {i}", category=DataCategory.PUBLIC)
+        log.info(f"private {i}")
+
+    lines = stream.getvalue().splitlines()
+    assert [line for line in lines if "public" in line] == ["public 0", "public 1"]
+    assert len([line for line in lines if "private" in line]) == 5
+
+
+def test_rate_limit_filter_tells_call_sites_apart(reset_root_handlers):
+    rate_limit = confidential_ml_utils.logging.RateLimitFilter(private_limit=1)
+    stream = io.StringIO()
+    reset_root_handlers()
+    confidential_ml_utils.enable_confidential_logging(
+        stream=stream,
+        format="%(filename)s:%(funcName)s:%(message)s",
+        rate_limit=rate_limit,
+    )
+    log = logging.getLogger("rate_limited")
+    log.setLevel("INFO")
+
+    for _ in range(2):
+        log.info("site A")
+        log.info("site B")
+        log.warning("site C")
+
+    assert stream.getvalue() == (
+        "test_logging.py:test_rate_limit_filter_tells_call_sites_apart:site A\n"
+        "test_logging.py:test_rate_limit_filter_tells_call_sites_apart:site B\n"
+        "test_logging.py:test_rate_limit_filter_tells_call_sites_apart:site C\n"
+    )
+
+
+def test_rate_limit_filter_reports_suppressed_records_of_idle_sites():
+    confidential_ml_utils.enable_confidential_logging()
+    rate_limit = confidential_ml_utils.logging.RateLimitFilter(
+        public_limit=1, private_limit=1, interval=10.0
+    )
+    log = logging.getLogger("confidential_ml_utils")
+    log.setLevel("INFO")
+
+    def record(lineno, created, category=DataCategory.PRIVATE):
+        return logging.makeLogRecord(
+            {
+                "msg": "step",
+                "pathname": "/src/train.py",
+                "lineno": lineno,
+                "levelno": logging.INFO,
+                "created": created,
+                "category": category,
+            }
+        )
+
+    with StreamHandlerContext(log, "%(prefix)s%(message)s") as context:
+        for created in [0.0, 1.0, 2.0]:
+            rate_limit.filter(record(1, created))
+            rate_limit.filter(record(2, created, DataCategory.PUBLIC))
+        assert str(context) == ""
+        # Line 1 logs again, line 2 does not: its count is reported anyway.
+        rate_limit.filter(record(1, 11.0))
+        rate_limit.filter(record(1, 12.0))
+        rate_limit.close()
+        logs = str(context)
+
+    assert logs == (
+        "SystemLog:2 records suppressed by the rate limit at train.py:2\n"
+        "1 records suppressed by the rate limit at train.py:1\n"
+    )
+
+
+def test_rate_limit_filter_reports_repeats_in_next_window():
+    rate_limit = confidential_ml_utils.logging.RateLimitFilter(
+        private_limit=1, interval=10.0
+    )
+    records = []
+    for created in [0.0, 1.0, 2.0, 11.0]:
+        record = logging.makeLogRecord(
+            {"msg": "step %d", "args": (int(created),), "created": created}
+        )
+        if rate_limit.filter(record):
+            records.append(record.getMessage())
+        # A second handler sharing the filter gets the same decision.
+        assert rate_limit.filter(record) == (record.getMessage() in records)
+
+    assert records == ["step 0", "step 11 [message repeated 2 times]"]
+
+
+def test_logging_stats_count_records_per_category_and_level(reset_root_handlers):
+    reset_root_handlers()
+    confidential_ml_utils.enable_confidential_logging(
+        stream=io.StringIO(), public_only=True, collect_stats=True
+    )
+    log = logging.getLogger("stats")
+    log.setLevel("INFO")
+    log.info("public", category=DataCategory.PUBLIC)
+    log.warning("public", category=DataCategory.PUBLIC)
+    log.warning("PRIVATE")
+
+    stats = confidential_ml_utils.logging.get_logging_stats()
+    assert stats["records"] == {"PUBLIC": {"INFO": 1, "WARNING": 1}}
+    assert stats["bytes"] == {"PUBLIC": {"INFO": 6, "WARNING": 6}}
+    assert stats["dropped"] == {"public_only": 1}
+    assert stats["log_seconds"] >= stats["handler_seconds"] > 0
+
+    confidential_ml_utils.enable_confidential_logging()
+    assert confidential_ml_utils.logging.get_logging_stats() is None
+
+
+def test_logging_stats_emit_public_summary(reset_root_handlers):
+    stream = io.StringIO()
+    reset_root_handlers()
+    confidential_ml_utils.enable_confidential_logging(
+        stream=stream,
+        level="INFO",
+        collect_stats=True,
+        stats_interval=1e-9,
+    )
+    log = logging.getLogger("stats")
+    log.info("PRIVATE")
+
+    assert re.search(
+        r"^SystemLog:INFO:confidential_ml_utils:Logging statistics: "
+        r"PRIVATE 1 records \(7 bytes\), PUBLIC 0 records \(0 bytes\)",
+        stream.getvalue(),
+        flags=re.MULTILINE,
+    )
+
+
+def test_public_exceptions_are_scrubbed_and_prefixed(reset_root_handlers):
+    from confidential_ml_utils.exceptions import SCRUB_MESSAGE
+
+    stream = io.StringIO()
+    reset_root_handlers()
+    confidential_ml_utils.enable_confidential_logging(stream=stream)
+    log = logging.getLogger("exceptions")
+    secret = "".join(["hun", "ter2"])
+
+    try:
+        raise ValueError(secret)
+    except ValueError:
+        log.exception("public failure", DataCategory.PUBLIC)
+        log.exception("private failure")
+
+    public, private = stream.getvalue().split("ERROR:exceptions:private failure")
+    lines = public.splitlines()
+    assert lines[0] == "SystemLog:ERROR:exceptions:public failure"
+    assert all(line.startswith("SystemLog: ") for line in lines[1:])
+    assert lines[-1] == f"SystemLog: ValueError: {SCRUB_MESSAGE}"
+    assert secret not in public
+    assert f"ValueError: {secret}" in private
+
+
+def test_public_exceptions_use_stack_trace_options(reset_root_handlers):
+    from confidential_ml_utils.exceptions import prefix_stack_trace
+
+    stream = io.StringIO()
+    reset_root_handlers()
+    confidential_ml_utils.enable_confidential_logging(
+        stream=stream,
+        stack_trace=prefix_stack_trace(allow_list=["KeyError"]),
+    )
+    log = logging.getLogger("exceptions")
+    records = []
+    log.addFilter(lambda record: records.append(record) or True)
+
+    try:
+        raise KeyError("allowed")
+    except KeyError as e:
+        log.error("failure", DataCategory.PUBLIC, exc_info=e)
+
+    assert "SystemLog: KeyError: 'allowed'" in stream.getvalue()
+    assert records[0].exc_info is None
@@ -3,6 +3,7 @@
 
 import confidential_ml_utils.stackTraceExtractor as ste
 import pathlib
+import pytest
 import re
 
 
@@ -92,3 +93,257 @@ def test_parse_file(capsys):
 
     assert re.match(target, captured.out)
     assert len(captured.out.split("\n")) == 13
+
+
+def test_parse_file_does_not_compile_patterns(monkeypatch, capsys):
+    """
+    Verify that patterns are compiled once, not for every line.
+    """
+
+    HERE = pathlib.Path(__file__).parent
+    file = str(HERE / "log.err")
+    extractor = ste.StackTraceExtractor()
+
+    def fail(*args, **kwargs):
+        raise AssertionError("re.compile called while parsing")
+
+    monkeypatch.setattr(re, "compile", fail)
+    extractor._parse_file(file)
+    assert "SystemLog: type: ZeroDivisionError" in capsys.readouterr().out
+
+
+def test_parse_line_skips_lines_without_anchors():
+    """
+    Verify that lines which cannot be part of a stack trace produce nothing.
+    """
+    extractor = ste.StackTraceExtractor()
+    assert extractor._parse_line("epoch 3, loss 0.25, at step 100\n") == []
+    assert extractor._parse_line("ValueError without colon\n") == []
+
+
+def test_parse_file_mmap_matches_text_mode(capsys):
+    """
+    Verify that memory-mapped scanning prints the same as line iteration.
+    """
+
+    HERE = pathlib.Path(__file__).parent
+    file = str(HERE / "log.err")
+    ste.StackTraceExtractor(show_exception_message=True)._parse_file(file)
+    text = capsys.readouterr().out
+    extractor = ste.StackTraceExtractor(show_exception_message=True, use_mmap=True)
+    extractor._parse_file(file)
+    assert capsys.readouterr().out == text
+
+
+def test_parse_file_mmap_tolerates_invalid_utf8(tmp_path, capsys):
+    """
+    Verify that invalid UTF-8 and Windows line endings are handled.
+    """
+    file = tmp_path / "rank0.err"
+    file.write_bytes(
+        b"\xff\xfe binary garbage\r\n"
+        b"Traceback (most recent call last):\r\n"
+        b'  File "train.py", line 3, in <module>\r\n'
+        b"ValueError: bad \xff value\r\n"
+        b"Error: no newline at end"
+    )
+    extractor = ste.StackTraceExtractor(show_exception_message=True, use_mmap=True)
+    extractor._parse_file(str(file))
+    out = capsys.readouterr().out
+    assert 'SystemLog: file: "train.py"\nSystemLog: line: 3\n' in out
+    assert "SystemLog: message: bad � value\n" in out
+
+    (tmp_path / "empty.err").write_bytes(b"")
+    extractor._parse_file(str(tmp_path / "empty.err"))
+    assert capsys.readouterr().out.startswith("SystemLog: Parsing file")
+
+
+def test_extract_parallel_is_ordered_and_isolates_errors(tmp_path, capsys):
+    """
+    Verify that parallel extraction prints the same as sequential extraction,
+    and that an unreadable file does not stop the others.
+    """
+
+    HERE = pathlib.Path(__file__).parent
+    content = (HERE / "log.err").read_bytes()
+    for rank in range(4):
+        (tmp_path / f"rank{rank}.err").write_bytes(content)
+    # Matched by the glob, but cannot be opened.
+    (tmp_path / "rank2b.err").symlink_to(tmp_path / "missing")
+
+    extractor = ste.StackTraceExtractor()
+    extractor.extract(str(tmp_path))
+    sequential = capsys.readouterr().out
+    extractor.extract(str(tmp_path), workers=3)
+    parallel = capsys.readouterr().out
+
+    assert parallel == sequential
+    parsed = re.findall(r"Parsing file .*(rank\w+)\.err", parallel)
+    assert parsed == ["rank0", "rank1", "rank2", "rank2b", "rank3"]
+    assert parallel.count("SystemLog: type: ZeroDivisionError") == 4
+    assert "SystemLog: Could not parse file: FileNotFoundError" in parallel
+    assert "problem with the exceptionExtractor" not in parallel
+
+
+def test_extract_recursive_include_exclude(tmp_path, capsys):
+    """
+    Verify recursive discovery with include and exclude patterns.
+    """
+    for name in [
+        "a.err",
+        "a.log",
+        "node0/rank0.err",
+        "node0/rank0.out",
+        "node1/rank1.err",
+        "node1/debug/rank1.err",
+        ".hidden/rank.err",
+    ]:
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_text("")
+    extractor = ste.StackTraceExtractor()
+
+    def parsed(**kwargs):
+        extractor.extract(str(tmp_path), **kwargs)
+        out = capsys.readouterr().out
+        return [
+            pathlib.Path(p).relative_to(tmp_path).as_posix()
+            for p in re.findall(r"Parsing file (.*)", out)
+        ]
+
+    assert parsed() == ["a.err"]
+    assert parsed(recursive=True) == [
+        "a.err",
+        "node0/rank0.err",
+        "node1/debug/rank1.err",
+        "node1/rank1.err",
+    ]
+    assert parsed(
+        recursive=True, include=["*.err", "*.out"], exclude=["node1/debug", "a.*"]
+    ) == ["node0/rank0.err", "node0/rank0.out", "node1/rank1.err"]
+
+
+@pytest.mark.parametrize("use_mmap", [False, True])
+def test_extract_checkpoint_parses_appended_bytes(tmp_path, capsys, use_mmap):
+    """
+    Verify that with a checkpoint, only appended bytes are parsed, across
+    runs, even when a trace is split between runs.
+    """
+    log = tmp_path / "rank0.err"
+    checkpoint = str(tmp_path / "checkpoint.json")
+    extractor = ste.StackTraceExtractor(use_mmap=use_mmap)
+
+    def run():
+        extractor.extract(str(log), checkpoint=checkpoint)
+        return capsys.readouterr().out
+
+    log.write_text('foo\nTraceback (most recent call last):\n  File "a.py", line')
+    out = run()
+    assert "Parsing file" in out and "SystemLog: file" not in out
+
+    with open(log, "a") as f:
+        f.write(" 1, in <module>\nKeyError: 'a'\n")
+    out = run()
+    assert "SystemLog: line: 1\n" in out
+    assert "SystemLog: type: KeyError\n" in out
+
+    assert run() == "SystemLog: Input is a file\n"
+
+    with open(log, "a") as f:
+        f.write("ValueError: not in a traceback\n")
+    out = run()
+    assert "Parsing file" in out and "SystemLog: type" not in out
+
+    # Truncated (e.g. rotated) files are parsed from the start.
+    log.write_text("Traceback (most recent call last):\nOSError: x\n")
+    assert "SystemLog: type: OSError\n" in run()
+
+
+@pytest.mark.parametrize("use_mmap", [False, True])
+def test_extract_checkpoint_prints_last_line_once(tmp_path, capsys, use_mmap):
+    """
+    Verify that a last line without newline is printed by a single run.
+    """
+    log = tmp_path / "rank0.err"
+    checkpoint = str(tmp_path / "checkpoint.json")
+    extractor = ste.StackTraceExtractor(use_mmap=use_mmap)
+
+    def run():
+        extractor.extract(str(log), checkpoint=checkpoint)
+        return capsys.readouterr().out
+
+    log.write_text('Traceback (most recent call last):\n  File "y.py", line 9, in g')
+    outputs = [run(), run()]
+    with open(log, "a") as f:
+        f.write("\n")
+    outputs += [run(), run()]
+
+    assert ["SystemLog: line: 9\n" in out for out in outputs] == [
+        False,
+        False,
+        True,
+        False,
+    ]
+
+
+def test_poll_tracks_new_partial_and_rotated_files(tmp_path):
+    """
+    Verify that polling only parses complete lines, picks up new files and
+    finishes rotated files.
+    """
+    extractor = ste.StackTraceExtractor()
+    entries = {}
+
+    def poll():
+        lines = extractor._poll(str(tmp_path), ["*.err"], [], False, entries, 1024)
+        return "\n".join(lines)
+
+    rank0 = tmp_path / "rank0.err"
+    rank0.write_text("epoch 1\nTraceback (most recent call last):\nKeyErr")
+    assert poll() == ""
+
+    with open(rank0, "a") as f:
+        f.write("or: 'a'\n")
+    (tmp_path / "rank1.err").write_text(
+        "Traceback (most recent call last):\nOSError: x\n"
+    )
+    out = poll()
+    assert re.search(r"rank0\.err\nSystemLog: type: KeyError$", out, re.MULTILINE)
+    assert re.search(r"rank1\.err\nSystemLog: type: OSError$", out, re.MULTILINE)
+    assert poll() == ""
+
+    with open(rank0, "a") as f:
+        f.write("Traceback (most recent call last):\n")
+    rank0.rename(tmp_path / "rank0.err.1")
+    with open(tmp_path / "rank0.err.1", "a") as f:
+        f.write("ValueError: before rotation\n")
+    rank0.write_text("Traceback (most recent call last):\nIOError: after\n")
+    out = poll()
+    assert out.index("ValueError") < out.index("IOError")
+    assert "rank1" not in out
+
+    # Lines too long to wait for are parsed without their end.
+    (tmp_path / "rank1.err").write_text("x" * 2000)
+    assert poll() == ""
+    assert entries[str(tmp_path / "rank1.err")]["offset"] == 2000
+
+
+def test_follow_stops(tmp_path, capsys):
+    """
+    Verify that following prints existing traces and stops when asked to.
+    """
+    import threading
+
+    HERE = pathlib.Path(__file__).parent
+    (tmp_path / "rank0.err").write_bytes((HERE / "log.err").read_bytes())
+    stop = threading.Event()
+    thread = threading.Thread(
+        target=ste.StackTraceExtractor().follow,
+        args=(str(tmp_path),),
+        kwargs={"interval": 0.01, "stop": stop},
+    )
+    thread.start()
+    stop.set()
+    thread.join(5)
+
+    assert not thread.is_alive()
+    assert "SystemLog: type: ZeroDivisionError" in capsys.readouterr().out
@@ -0,0 +1,78 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import confidential_ml_utils
+from confidential_ml_utils.constants import DataCategory
+from confidential_ml_utils.exceptions import SCRUB_MESSAGE
+from confidential_ml_utils.structured import (
+    BinaryFileHandler,
+    JsonFormatter,
+    read_records,
+)
+import json
+import logging
+import pytest
+
+
+def log_sample_records(handler: logging.Handler, reset_root_handlers) -> None:
+    reset_root_handlers()
+    confidential_ml_utils.enable_confidential_logging(handlers=[handler])
+    log = logging.getLogger("structured")
+    log.setLevel("INFO")
+    log.info("public", category=DataCategory.PUBLIC)
+    log.warning("private %s", DataCategory.PRIVATE, "ünïcode")
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        log.error("failed", category=DataCategory.PUBLIC, exc_info=True)
+    reset_root_handlers()
+
+
+def test_json_formatter_emits_one_object_per_line():
+    record = logging.makeLogRecord(
+        {
+            "msg": "value %d",
+            "args": (3,),
+            "levelname": "INFO",
+            "name": "json",
+            "prefix": "SystemLog:",
+            "category": DataCategory.PUBLIC,
+        }
+    )
+    fields = json.loads(JsonFormatter().format(record))
+    assert fields["message"] == "value 3"
+    assert fields["category"] == "PUBLIC"
+    assert fields["prefix"] == "SystemLog:"
+    assert "exc_text" not in fields
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_read_records_round_trips(tmp_path, binary, reset_root_handlers):
+    path = str(tmp_path / "out.log")
+    if binary:
+        handler = BinaryFileHandler(path)
+    else:
+        handler = logging.FileHandler(path, encoding="utf-8")
+        handler.setFormatter(JsonFormatter())
+    log_sample_records(handler, reset_root_handlers)
+
+    records = list(read_records(path))
+    assert [
+        (r["levelname"], r["category"], r["prefix"], r["message"]) for r in records
+    ] == [
+        ("INFO", "PUBLIC", "SystemLog:", "public"),
+        ("WARNING", "PRIVATE", "", "private ünïcode"),
+        ("ERROR", "PUBLIC", "SystemLog:", "failed"),
+    ]
+    assert records[0]["name"] == "structured"
+    # Exceptions of PUBLIC records are scrubbed.
+    assert f"ValueError: {SCRUB_MESSAGE}" in records[2]["exc_text"]
+
+
+def test_read_records_ignores_truncated_frame(tmp_path, reset_root_handlers):
+    path = str(tmp_path / "out.bin")
+    log_sample_records(BinaryFileHandler(path), reset_root_handlers)
+    with open(path, "rb+") as f:
+        f.truncate(f.seek(0, 2) - 3)
+
+    assert len(list(read_records(path))) == 2